@@ -1,3 +1,4 @@
+import math
 import torch 
 import numpy as np 
 import gc 
@@ -6,6 +7,10 @@ from gpytorch.kernels import(
     RBFKernel, LinearKernel, MaternKernel, RQKernel, PeriodicKernel,
     CosineKernel, PolynomialKernel 
 )
+from gaussian_process.kernels import sq_dist, build_kernel, native_kernel_dict, kernel_mean_and_grad
+from gaussian_process.pathwise import RandomFourierFeatures
+from gaussian_process.solvers import tiled_matvec, cholesky_, pivoted_cholesky, WoodburyPreconditioner, pcg
+from gaussian_process.distributed import DistributedCholesky
 kernel_dict = {'rbf': RBFKernel,'matern': MaternKernel, 
                 'rq' : RQKernel, 'period': PeriodicKernel, 'cosine': CosineKernel,
                 'poly': PolynomialKernel}
@@ -17,46 +22,362 @@ class GP_hyper:
         self.noise = noise 
         self.mean_prior = mean_prior 
 class GP: 
-    def __init__(self,device, x_train, y_train, lengthscale, variance, noise, mean_prior, kernel='rbf'):
+    def __init__(self,device, x_train, y_train, lengthscale, variance, noise, mean_prior, kernel='rbf', bank=None, cache_key=None,
+                 kernel_impl='native', cache_sq_dist=True, solver='cholesky', cg_tol=1e-4, cg_max_iter=1000,
+                 cg_tile_size=1024, precond_rank=100, tile_size=None, tile_memory_mb=None, num_workers=None,
+                 block_size=2048):
         
         self.device = device 
         self.x_train = x_train
         self.y_train = y_train 
-        self.kernel = kernel_dict[kernel]().to(device)
+        self.kernel_name = kernel
+        # 'native' kernels build K_train_train in place, in the previous factor's buffer; 'gpytorch' keeps the original path
+        self.kernel_impl = kernel_impl
+        if kernel_impl == 'native':
+            self.kernel = native_kernel_dict[kernel]().to(device)
+        else:
+            self.kernel = kernel_dict[kernel]().to(device)
         self.noise = noise
         self.variance = variance
         self.mean_prior = mean_prior
         self.kernel.lengthscale = lengthscale
+        # Cholesky factor of K_train_train and the hyperparameters it was built with
+        self.L = None
+        self.factor_key = None
+        # optional FactorBank shared across GP instances; cache_key names the x_train it holds
+        self.bank = bank
+        self.cache_key = cache_key
+        # ||xi - xj||^2 over x_train, computed once and shared by every lengthscale
+        self.cache_sq_dist = cache_sq_dist
+        self.sq_dist = None
+        self.K_train_train = None
+        # 'cholesky' factorizes K_train_train; 'cg' runs preconditioned conjugate gradients on
+        # row-tiled kernel products and never materializes K; 'eigh' eigendecomposes the
+        # unit-variance kernel once per lengthscale so any (variance, noise) solves in O(N^2);
+        # 'distributed' runs a blocked Cholesky on shared-memory tiles across local worker processes
+        self.solver = solver
+        self.backend = DistributedCholesky(num_workers, block_size) if solver == 'distributed' else None
+        # block size of the in-place factorization as well
+        self.block_size = block_size
+        self.cg_tol = cg_tol
+        self.cg_max_iter = cg_max_iter
+        self.cg_tile_size = cg_tile_size
+        self.precond_rank = precond_rank
+        self.precond = None
+        self.precond_key = None
+        self.eig = None
+        self.eig_key = None
+        # test points are streamed through kernel tiles of tile_size rows (or as many rows as fit
+        # in tile_memory_mb) reusing one scratch buffer; None keeps the single-shot product
+        self.tile_size = tile_size
+        self.tile_memory_mb = tile_memory_mb
+        self.tile_buffer = None
         
+    def hyper_key(self):
+        lengthscale = torch.as_tensor(self.kernel.lengthscale).detach().flatten().tolist()
+        variance = torch.as_tensor(self.variance).detach().flatten().tolist()
+        noise = torch.as_tensor(self.noise).detach().flatten().tolist()
+        return (tuple(lengthscale), tuple(variance), tuple(noise))
+
+    def train_sq_dist(self):
+        if self.sq_dist is not None:
+            return self.sq_dist
+        use_bank = self.bank is not None and self.cache_key is not None
+        if use_bank:
+            entry = self.bank.get((self.cache_key, 'sq_dist'))
+            if entry is not None:
+                self.sq_dist = entry['sq_dist']
+                return self.sq_dist
+        with torch.no_grad():
+            self.sq_dist = sq_dist(self.x_train, self.x_train, x1_eq_x2=True)
+        if use_bank:
+            self.bank.put((self.cache_key, 'sq_dist'), {'sq_dist': self.sq_dist})
+        return self.sq_dist
+
+    def factorize(self):
+        # reuse the factor while (x_train, lengthscale, variance, noise) is unchanged
+        key = self.hyper_key()
+        if self.L is not None and self.factor_key == key:
+            return self.L
+        use_bank = self.bank is not None and self.cache_key is not None
+        if use_bank:
+            entry = self.bank.get((self.cache_key,) + key)
+            if entry is not None:
+                self.K_train_train, self.L = entry['K'], entry['L']
+                self.factor_key = key
+                return self.L
+        if self.solver == 'distributed':
+            # the factor overwrites the kernel in the shared buffer, which is refilled on the next call
+            buffer = None if use_bank else self.L
+            self.L = self.backend.factorize(self.kernel_name, self.x_train, self.kernel.lengthscale,
+                                            self.variance, self.noise, A=buffer)
+            self.factor_key = key
+            if use_bank:
+                self.bank.put((self.cache_key,) + key, {'K': None, 'L': self.L})
+            return self.L
+        with torch.no_grad():
+            if self.kernel_impl == 'native':
+                # build the kernel into the previous factor's buffer unless the bank still holds it;
+                # only the factor is kept afterwards, so one N x N matrix stays resident
+                buffer = None
+                if not use_bank and self.L is not None and self.L.shape[-1] == self.x_train.shape[0]:
+                    buffer, self.L = self.L, None
+                K = build_kernel(self.kernel, self.x_train,
+                                 variance=self.variance,
+                                 jitter=self.noise,
+                                 out=buffer,
+                                 sq_dists=self.train_sq_dist() if self.cache_sq_dist else None)
+            else:
+                K = self.variance*self.kernel.forward(self.x_train, self.x_train)
+                K.diagonal().add_(self.noise)  # In-place modification
+            # factorized in place, so K's buffer becomes the factor
+            self.L = cholesky_(K, block_size=self.block_size)
+            del K
+        self.K_train_train = None
+        self.factor_key = key
+        if use_bank:
+            self.bank.put((self.cache_key,) + key, {'K': None, 'L': self.L})
+        return self.L
+
+    def covariance(self, x1, x2, out=None, method='matmul'):
+        # variance*K(x1, x2) without noise or autograd, written into out when given
+        with torch.no_grad():
+            if self.kernel_impl == 'native':
+                return build_kernel(self.kernel, x1, x2, variance=self.variance, out=out, method=method)
+            K = self.variance*self.kernel.forward(x1, x2)
+            return K if out is None else out.copy_(K)
+
+    def kernel_rows(self, x, out=None):
+        return self.covariance(x, self.x_train, out=out)
+
+    def preconditioner(self):
+        key = self.hyper_key()
+        if self.precond is None or self.precond_key != key:
+            with torch.no_grad():
+                diag = torch.as_tensor(self.variance, device=self.x_train.device).reshape(-1)[0].expand(self.x_train.shape[0])
+                L = pivoted_cholesky(self.kernel_rows, self.x_train, diag, rank=min(self.precond_rank, self.x_train.shape[0]))
+                self.precond = WoodburyPreconditioner(L, self.noise)
+            self.precond_key = key
+        return self.precond
+
+    def solve_cg(self, b):
+        matvec = lambda v: tiled_matvec(self.kernel_rows, self.x_train, v, self.noise, tile_size=self.cg_tile_size)
+        coef, self.cg_iterations = pcg(matvec, b, precond=self.preconditioner(), tol=self.cg_tol, max_iter=self.cg_max_iter)
+        return coef
+
+    def eigendecompose(self):
+        # K0 = Q diag(evals) Q^T for the unit-variance, noise-free kernel at the current lengthscale
+        key = tuple(torch.as_tensor(self.kernel.lengthscale).detach().flatten().tolist())
+        if self.eig is not None and self.eig_key == key:
+            return self.eig
+        use_bank = self.bank is not None and self.cache_key is not None
+        if use_bank:
+            entry = self.bank.get((self.cache_key, 'eigh', key))
+            if entry is not None:
+                self.eig, self.eig_key = (entry['evals'], entry['Q']), key
+                return self.eig
+        with torch.no_grad():
+            if self.kernel_impl == 'native':
+                K0 = build_kernel(self.kernel, self.x_train, variance=1.0,
+                                  sq_dists=self.train_sq_dist() if self.cache_sq_dist else None)
+            else:
+                K0 = self.kernel.forward(self.x_train, self.x_train)
+            evals, Q = torch.linalg.eigh(K0)
+            del K0
+            evals.clamp_min_(0)
+        self.eig, self.eig_key = (evals, Q), key
+        if use_bank:
+            self.bank.put((self.cache_key, 'eigh', key), {'evals': evals, 'Q': Q})
+        return self.eig
+
+    def solve_eigh(self, b):
+        # (variance*K0 + noise*I)^{-1} b = Q diag(1/(variance*evals + noise)) Q^T b
+        evals, Q = self.eigendecompose()
+        denom = (evals*self.variance + self.noise).unsqueeze(-1)
+        return torch.matmul(Q, torch.matmul(Q.T, b).div_(denom))
+
+    def log_marginal_likelihood(self, y=None):
+        # log N(y | mean_prior, variance*K0 + noise*I); (F,) values when y is (N, F)
+        y = self.y_train if y is None else y
+        with torch.no_grad():
+            b = y - self.mean_prior
+            squeeze = b.dim() == 1
+            if squeeze:
+                b = b.unsqueeze(-1)
+            N = b.shape[0]
+            if self.solver == 'eigh':
+                evals, Q = self.eigendecompose()
+                denom = evals*self.variance + self.noise
+                fit = (torch.matmul(Q.T, b).pow(2)/denom.unsqueeze(-1)).sum(0)
+                logdet = torch.log(denom).sum()
+            elif self.solver in ('cholesky', 'distributed'):
+                L = self.factorize().to(b.device)
+                fit = torch.linalg.solve_triangular(L, b, upper=False).pow(2).sum(0)
+                logdet = 2*torch.log(L.diagonal()).sum()
+            else:
+                raise NotImplementedError(f'log marginal likelihood is not available for solver {self.solver}')
+            lml = -0.5*fit - 0.5*logdet - 0.5*N*math.log(2*math.pi)
+        return lml.squeeze(-1) if squeeze else lml
+
+    def solve_centered(self, b):
+        # (K + noise*I)^{-1} b for b of shape (N,) or (N, F)
+        with torch.no_grad():
+            if self.solver == 'cg':
+                return self.solve_cg(b).detach()
+            if self.solver == 'distributed':
+                return self.backend.solve(self.factorize(), b)
+            if self.solver == 'eigh':
+                if b.dim() == 1:
+                    return self.solve_eigh(b.unsqueeze(-1)).squeeze(-1).detach()
+                return self.solve_eigh(b).detach()
+            if b.dim() == 1:
+                return torch.cholesky_solve(b.unsqueeze(-1), self.factorize()).squeeze(-1).detach()
+            return torch.cholesky_solve(b, self.factorize()).detach()
+
+    def solve(self, y):
+        # y: (N,) or (N, F); all F label vectors are solved against one factor in a single call
+        return self.solve_centered(y - self.mean_prior)
+
     def set_hyper(self, lengthscale, variance): 
         
         self.variance = variance 
         self.kernel.lengthscale = lengthscale
         if hasattr(self, 'coef'):
             del self.coef
-        # torch.cuda.empty_cache()
-        with torch.no_grad():
-            # import pdb; pdb.set_trace()
-            self.K_train_train = self.variance*self.kernel.forward(self.x_train, self.x_train)
-            self.K_train_train.diagonal().add_(self.noise)  # In-place modification
-            L = torch.linalg.cholesky(self.K_train_train)
-            b = (self.y_train - self.mean_prior).unsqueeze(-1)
-            self.coef = torch.cholesky_solve(b, L).squeeze(-1).detach()
-            #del K_train_train, L, b 
-            # torch.cuda.empty_cache()
-
-    def sampling_pseudo_label(self): 
-        normal_dist = torch.distributions.Normal(0.0,1.0)
-        epsilon = normal_dist.sample((self.x_train.shape[0],)).to(self.device)
-        return torch.matmul(self.K_train_train,epsilon)
+        self.coef = self.solve(self.y_train)
+
+    def set_labels(self, y_train):
+        # refit on new labels for the same inputs, keeping the current factor
+        self.y_train = y_train
+        self.coef = self.solve(y_train)
+
+    def extend_factor(self, x_new):
+        # [[L, 0], [B^T, C]] with B = L^{-1} K(X, X_new) and C = chol(K(X_new, X_new) + noise*I - B^T B)
+        N, k = self.L.shape[0], x_new.shape[0]
+        B = torch.linalg.solve_triangular(self.L, self.covariance(self.x_train, x_new), upper=False)
+        S = self.covariance(x_new, x_new)
+        S.diagonal().add_(self.noise)
+        S.sub_(torch.matmul(B.T, B))
+        L = self.L.new_zeros(N + k, N + k)
+        L[:N, :N] = self.L
+        L[N:, :N] = B.T
+        L[N:, N:] = torch.linalg.cholesky(S)
+        return L
+
+    def extend_sq_dist(self, x_new):
+        N, k = self.sq_dist.shape[0], x_new.shape[0]
+        D = self.sq_dist.new_empty(N + k, N + k)
+        D[:N, :N] = self.sq_dist
+        D[N:, :N] = sq_dist(x_new, self.x_train)
+        D[:N, N:] = D[N:, :N].T
+        D[N:, N:] = sq_dist(x_new, x_new, x1_eq_x2=True)
+        return D
+
+    def add_points(self, x_new, y_new, cache_key=None):
+        # append k labelled points; a current Cholesky factor is extended blockwise in O(N^2 k)
+        # instead of refactorized. cache_key names the grown x_train in the bank (None detaches it).
+        extend = self.solver == 'cholesky' and self.L is not None and self.factor_key == self.hyper_key()
+        with torch.no_grad():
+            if extend:
+                self.L = self.extend_factor(x_new)
+            else:
+                self.L, self.factor_key = None, None
+            if self.sq_dist is not None:
+                self.sq_dist = self.extend_sq_dist(x_new)
+        self.x_train = torch.cat([self.x_train, x_new])
+        self.y_train = torch.cat([self.y_train, y_new])
+        self.K_train_train = None
+        self.precond, self.precond_key = None, None
+        self.eig, self.eig_key = None, None
+        self.cache_key = cache_key
+        if self.bank is not None and cache_key is not None and self.sq_dist is not None:
+            self.bank.put((cache_key, 'sq_dist'), {'sq_dist': self.sq_dist})
+        self.coef = self.solve(self.y_train)
+
+    def variance_posterior(self, x_test, out=None):
+        # diag of variance*k(x, x) - K(x, X) (K + noise*I)^{-1} K(X, x), streamed like mean_posterior;
+        # the kernels are stationary so k(x, x) = 1
+        with torch.no_grad():
+            M = x_test.shape[0]
+            tile_size = self.test_tile_size(M) or M
+            if out is None:
+                out = torch.empty(M, dtype=self.x_train.dtype, device=self.x_train.device)
+            buffer = self.scratch(tile_size)
+            for start in range(0, M, tile_size):
+                end = min(start + tile_size, M)
+                K_tile = self.covariance(x_test[start:end], self.x_train, out=buffer[:end-start])
+                if self.solver == 'cholesky':
+                    reduction = torch.linalg.solve_triangular(self.factorize(), K_tile.T, upper=False).pow(2).sum(0)
+                else:
+                    reduction = (K_tile.T*self.solve_centered(K_tile.T)).sum(0)
+                out[start:end] = self.variance - reduction
+            out.clamp_min_(0)
+        return out
+
+    def sampling_pseudo_label(self, num_features=1024): 
+        # prior draw at x_train from random Fourier features: O(N F D) instead of a product with K
+        features = RandomFourierFeatures(self, num_features)
+        with torch.no_grad():
+            weights = torch.randn(num_features, dtype=self.x_train.dtype, device=self.x_train.device)
+            return self.mean_prior + torch.matmul(features(self.x_train), weights)
     
-    def mean_posterior(self, x_test): 
+    def basis(self):
+        # points the coef vector is defined on; approximations override this
+        return self.x_train
+
+    def test_tile_size(self, num_test):
+        num_basis = self.basis().shape[0]
+        if self.tile_size is not None:
+            return max(1, min(self.tile_size, num_test))
+        if self.tile_memory_mb is not None:
+            rows = int(self.tile_memory_mb*1024**2)//(num_basis*self.x_train.element_size())
+            return max(1, min(rows, num_test))
+        return None
+
+    def scratch(self, rows):
+        # one (rows, num_basis) buffer kept across calls and grown only when too small
+        num_basis = self.basis().shape[0]
+        if (self.tile_buffer is None or self.tile_buffer.shape[0] < rows or self.tile_buffer.shape[1] != num_basis
+                or self.tile_buffer.dtype != self.x_train.dtype):
+            self.tile_buffer = torch.empty(rows, num_basis, dtype=self.x_train.dtype, device=self.x_train.device)
+        return self.tile_buffer[:rows]
+
+    def mean_posterior_tiled(self, x_test, tile_size, out=None):
+        # mu = m + K(x_test, basis) coef, tile by tile into a preallocated output
+        with torch.no_grad():
+            basis = self.basis()
+            M = x_test.shape[0]
+            if out is None:
+                out = torch.empty((M,) + self.coef.shape[1:], dtype=self.coef.dtype, device=self.coef.device)
+            buffer = self.scratch(tile_size)
+            for start in range(0, M, tile_size):
+                end = min(start + tile_size, M)
+                K_tile = self.covariance(x_test[start:end], basis, out=buffer[:end-start])
+                torch.matmul(K_tile, self.coef, out=out[start:end])
+            out.add_(self.mean_prior)
+        return out
+
+    def mean_posterior(self, x_test, out=None): 
+        tile_size = self.test_tile_size(x_test.shape[0])
+        if tile_size is not None and self.kernel_impl == 'native' and not x_test.requires_grad:
+            return self.mean_posterior_tiled(x_test, tile_size, out=out)
         # Posterior mean
-        K_train_test = self.variance * self.kernel.forward(self.x_train, x_test)
+        K_train_test = self.variance * self.kernel.forward(self.basis(), x_test)
         mu_star = self.mean_prior + torch.matmul(K_train_test.T, self.coef)
         # Posterior covariance
         #K_star_star = K_test_test - torch.matmul(K_train_test.T, torch.matmul(K_train_train_inv, K_train_test))
 
+        if out is not None:
+            return out.copy_(mu_star)
         return mu_star
-    
-    
\ No newline at end of file
+
+    def mean_and_grad(self, x_test):
+        # posterior mean and its gradient w.r.t. x_test without building an autograd graph
+        if self.kernel_impl == 'native':
+            mu, grad = kernel_mean_and_grad(self.kernel, self.basis(), self.coef, x_test, self.variance)
+            return self.mean_prior + mu, grad
+        x_test = x_test.detach().requires_grad_(True)
+        with torch.enable_grad():
+            mu_star = self.mean_posterior(x_test)
+            grad = torch.autograd.grad(mu_star.sum(), x_test)[0]
+        return mu_star.detach(), grad
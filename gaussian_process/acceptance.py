@@ -0,0 +1,56 @@
+import math
+import torch
+
+class AcceptanceTracker:
+    # per-function share of start points whose (high, low) pair survives threshold_diff, smoothed
+    # towards prior_rate with prior_count pseudo-trials, and the start points a target then needs
+    def __init__(self, prior_rate=0.5, prior_count=8, min_rate=0.05):
+        self.prior_rate = prior_rate
+        self.prior_count = prior_count
+        self.min_rate = min_rate
+        self.accepted = {}
+        self.tried = {}
+
+    def update(self, function, accepted, tried):
+        self.accepted[function] = self.accepted.get(function, 0) + accepted
+        self.tried[function] = self.tried.get(function, 0) + tried
+
+    def rate(self, function):
+        accepted, tried = self.accepted.get(function, 0), self.tried.get(function, 0)
+        return (accepted + self.prior_rate*self.prior_count)/(tried + self.prior_count)
+
+    def points_needed(self, function, num_pairs):
+        return math.ceil(num_pairs/max(self.rate(function), self.min_rate))
+
+class GapPruner:
+    # Rows i and i+n of joint_x are the low and high design of pair i. From prune_after steps on,
+    # a pair whose gap mu_high - mu_low is at most threshold and stays there when its last
+    # one-step growth is extrapolated over the remaining steps is frozen: it would be rejected.
+    # Frozen rows keep their last mean, so pairs with one converged row are still tracked.
+    def __init__(self, threshold, num_steps, prune_after=10):
+        self.threshold = threshold
+        self.num_steps = num_steps
+        self.prune_after = prune_after
+        self.mu = None
+        self.gap = None
+        self.hopeless = None
+
+    def __call__(self, t, active, mu):
+        if self.mu is None:
+            self.mu = mu.detach().clone()
+        else:
+            self.mu[..., active] = mu.detach()
+        n = self.mu.shape[-1]//2
+        gap = self.mu[..., n:] - self.mu[..., :n]
+        growth = gap - self.gap if self.gap is not None else None
+        self.gap = gap
+        if self.hopeless is None:
+            self.hopeless = torch.zeros_like(gap, dtype=torch.bool)
+        if t < self.prune_after or growth is None:
+            return torch.zeros_like(mu, dtype=torch.bool)
+        projected = gap + growth.clamp_min(0)*(self.num_steps - t)
+        self.hopeless |= projected <= self.threshold
+        return torch.cat((self.hopeless, self.hopeless), dim=-1)[..., active]
+
+    def num_pruned(self):
+        return 0 if self.hopeless is None else int(self.hopeless.sum())
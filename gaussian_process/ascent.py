@@ -0,0 +1,130 @@
+import torch
+
+class DesignAscent:
+    # Moves designs along +/- the posterior mean gradient: rows with direction +1 are ascended,
+    # rows with -1 descended. x is (M, D), or (F, M, D) for a batch of F functions, in which case
+    # a row leaves the active set once it is done in every function.
+    #   sgd          - fixed steps of learning_rate*grad (the original ascent)
+    #   adam         - Adam on the signed gradient
+    #   backtracking - per-row Armijo line search, starting from the row's last accepted step
+    #                  grown by 1/shrink (at most max_growth*learning_rate)
+    # A row is done once its gradient norm drops below grad_tol, its mean moves less than mu_tol
+    # in one step, its line search fails, its next step is not finite or prune(t, active, mu)
+    # flags it. Done rows are frozen and dropped from later kernel products; active_history
+    # holds the active rows per step.
+    def __init__(self, optimizer='sgd', num_steps=100, learning_rate=1e-3, grad_tol=0.0, mu_tol=0.0,
+                 betas=(0.9, 0.999), eps=1e-8, shrink=0.5, armijo=1e-4, max_backtracks=10, max_growth=100.0):
+        if optimizer not in ('sgd', 'adam', 'backtracking'):
+            raise NotImplementedError(f'Ascent optimizer {optimizer} not understood.')
+        self.optimizer = optimizer
+        self.num_steps = num_steps
+        self.learning_rate = learning_rate
+        self.grad_tol = grad_tol
+        self.mu_tol = mu_tol
+        self.betas = betas
+        self.eps = eps
+        self.shrink = shrink
+        self.armijo = armijo
+        self.max_backtracks = max_backtracks
+        self.max_growth = max_growth
+        self.active_history = []
+
+    def line_search(self, objective, x, mu, g, direction, rate):
+        # largest rate*shrink^k with direction*mu(x + a g) >= direction*mu(x) + armijo*a*|g|^2
+        accepted = torch.zeros_like(mu, dtype=torch.bool)
+        a = rate.clone()
+        sq_norm = (g*g).sum(-1)
+        for _ in range(self.max_backtracks):
+            # the trial points only need the mean
+            with torch.no_grad():
+                mu_trial = objective.mean_posterior(x + a.unsqueeze(-1)*g)
+            accepted |= direction*mu_trial >= direction*mu + self.armijo*a*sq_norm
+            if accepted.all():
+                break
+            a = torch.where(accepted, a, a*self.shrink)
+        return accepted, a
+
+    def run(self, objective, x, direction, prune=None):
+        M = x.shape[-2]
+        batch_shape = x.shape[:-2]
+        direction = direction.to(x)
+        done = torch.zeros(batch_shape + (M,), dtype=torch.bool, device=x.device)
+        active = torch.arange(M, device=x.device)
+        mu_prev = None
+        if self.optimizer == 'adam':
+            m, v = torch.zeros_like(x), torch.zeros_like(x)
+        if self.optimizer == 'backtracking':
+            rate = torch.full(batch_shape + (M,), self.learning_rate, dtype=x.dtype, device=x.device)
+        self.active_history = []
+        for t in range(self.num_steps):
+            full = active.shape[0] == M
+            xa = x if full else x[..., active, :]
+            da = direction if full else direction[active]
+            done_a = done if full else done[..., active]
+            self.active_history.append(int(active.shape[0]))
+            mu, grad = objective.mean_and_grad(xa)
+            converged = torch.zeros_like(done_a)
+            if self.grad_tol > 0:
+                converged |= grad.norm(dim=-1) < self.grad_tol
+            if self.mu_tol > 0 and mu_prev is not None:
+                converged |= (mu - (mu_prev if full else mu_prev[..., active])).abs() < self.mu_tol
+            if prune is not None:
+                converged |= prune(t, active, mu)
+            if self.optimizer == 'sgd':
+                step = (self.learning_rate*da).unsqueeze(-1)*grad
+            else:
+                g = da.unsqueeze(-1)*grad
+                if self.optimizer == 'adam':
+                    ma = self.betas[0]*(m if full else m[..., active, :]) + (1 - self.betas[0])*g
+                    va = self.betas[1]*(v if full else v[..., active, :]) + (1 - self.betas[1])*g*g
+                    if full:
+                        m, v = ma, va
+                    else:
+                        m[..., active, :], v[..., active, :] = ma, va
+                    m_hat = ma/(1 - self.betas[0]**(t + 1))
+                    v_hat = va/(1 - self.betas[1]**(t + 1))
+                    step = self.learning_rate*m_hat/(v_hat.sqrt() + self.eps)
+                else:
+                    accepted, a = self.line_search(objective, xa, mu, g, da, rate if full else rate[..., active])
+                    converged |= ~accepted
+                    grown = torch.clamp(a/self.shrink, max=self.max_growth*self.learning_rate)
+                    if full:
+                        rate = grown
+                    else:
+                        rate[..., active] = grown
+                    step = torch.where(accepted, a, torch.zeros_like(a)).unsqueeze(-1)*g
+            # diverging rows keep their last finite design
+            converged |= ~torch.isfinite(xa + step).all(-1)
+            frozen = done_a | converged
+            if frozen.any():
+                step = step.masked_fill(frozen.unsqueeze(-1), 0.)
+            if full:
+                x += step
+            else:
+                x[..., active, :] = xa + step
+            if self.mu_tol > 0:
+                if mu_prev is None:
+                    mu_prev = mu.detach().clone()
+                elif full:
+                    mu_prev = mu.detach()
+                else:
+                    mu_prev[..., active] = mu.detach()
+            if not frozen.any():
+                continue
+            if full:
+                done = frozen
+            else:
+                done[..., active] = frozen
+            # a row leaves the kernel products once it is done in every function
+            still = ~frozen.reshape(-1, active.shape[0]).all(0)
+            active = active[still]
+            if active.shape[0] == 0:
+                break
+        return x
+
+    def summary(self):
+        history = self.active_history
+        if not history:
+            return 'ascent: no steps'
+        return (f'ascent ({self.optimizer}): {len(history)} steps, active rows {history[0]} -> {history[-1]}, '
+                f'{sum(history)/(history[0]*self.num_steps):.1%} of the fixed-step kernel rows')
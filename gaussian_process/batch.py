@@ -0,0 +1,98 @@
+import torch
+from gaussian_process.kernels import sq_dist, native_kernel_dict, kernel_mean_and_grad
+
+class BatchGP:
+    # F exact GPs with per-function lengthscale/variance (length-F tensors), factorized with one
+    # batched Cholesky. x_train is (N, D) shared by all functions or (F, N, D); labels are (N,)
+    # or (F, N). Posterior means and gradients take designs of shape (F, M, D).
+    def __init__(self, device, x_train, y_train, lengthscale, variance, noise, mean_prior, kernel='rbf', chunk_size=1024):
+        self.device = device
+        self.x_train = x_train
+        self.y_train = y_train
+        self.kernel_name = kernel
+        self.kernel = native_kernel_dict[kernel]().to(device)
+        self.noise = noise
+        self.mean_prior = mean_prior
+        self.chunk_size = chunk_size
+        self.sq_dist = None
+        self.L = None
+        self.factor_key = None
+        self.set_params(lengthscale, variance)
+
+    @classmethod
+    def from_refit(cls, gp, coef, lengthscale=None, variance=None):
+        # batched view of one GP solved for F label vectors (coef is (N, F) from gp.solve); lengthscale
+        # and variance list the hyperparameters each column was solved under, by default the GP's
+        num_functions = coef.shape[1]
+        per_function = lambda values, default: (torch.as_tensor(default).detach().reshape(-1).expand(num_functions)
+                                                if values is None else
+                                                torch.cat([torch.as_tensor(v).detach().reshape(-1) for v in values]))
+        batch = cls(gp.device, gp.basis(), None,
+                    lengthscale=per_function(lengthscale, gp.kernel.lengthscale),
+                    variance=per_function(variance, gp.variance),
+                    noise=gp.noise, mean_prior=gp.mean_prior, kernel=gp.kernel_name)
+        batch.coef = coef.T
+        return batch
+
+    def set_params(self, lengthscale, variance):
+        self.lengthscale = torch.as_tensor(lengthscale, device=self.device).reshape(-1)
+        self.variance = torch.as_tensor(variance, device=self.device).reshape(-1)
+        self.num_functions = max(self.lengthscale.shape[0], self.variance.shape[0])
+        self.lengthscale = self.lengthscale.expand(self.num_functions)
+        self.variance = self.variance.expand(self.num_functions)
+
+    def hyper_key(self):
+        return (tuple(self.lengthscale.tolist()), tuple(self.variance.tolist()),
+                tuple(torch.as_tensor(self.noise).reshape(-1).tolist()))
+
+    def train_sq_dist(self):
+        if self.sq_dist is None:
+            with torch.no_grad():
+                self.sq_dist = sq_dist(self.x_train, self.x_train, x1_eq_x2=True)
+        return self.sq_dist
+
+    def factorize(self):
+        key = self.hyper_key()
+        if self.L is not None and self.factor_key == key:
+            return self.L
+        with torch.no_grad():
+            # (F, N, N) kernel stack derived from the shared squared distances
+            K = torch.div(self.train_sq_dist(), self.lengthscale.reshape(-1, 1, 1).pow(2))
+            self.kernel.transform_(K)
+            K.mul_(self.variance.reshape(-1, 1, 1))
+            K.diagonal(dim1=-2, dim2=-1).add_(self.noise)
+            self.L = torch.linalg.cholesky(K)
+        self.factor_key = key
+        return self.L
+
+    def labels(self, y):
+        # labels are (N,) shared by all functions or (F, N) with one row per function
+        return y.expand(self.num_functions, -1) if y.dim() == 1 else y
+
+    def solve(self, y):
+        with torch.no_grad():
+            b = (self.labels(y) - self.mean_prior).unsqueeze(-1)
+            return torch.cholesky_solve(b, self.factorize()).squeeze(-1)
+
+    def set_hyper(self, lengthscale, variance):
+        self.set_params(lengthscale, variance)
+        self.coef = self.solve(self.y_train)
+
+    def basis(self):
+        return self.x_train
+
+    def mean_posterior(self, x_test):
+        # (F, M) posterior means; x_test is (M, D) shared or (F, M, D)
+        with torch.no_grad():
+            lengthscale = self.lengthscale.reshape(-1, 1, 1)
+            mu = []
+            for start in range(0, x_test.shape[-2], self.chunk_size):
+                K = self.kernel.transform(sq_dist(x_test[..., start:start+self.chunk_size, :]/lengthscale,
+                                                  self.basis()/lengthscale))
+                mu.append(torch.matmul(K, self.coef.unsqueeze(-1)).squeeze(-1))
+            return self.mean_prior + self.variance.reshape(-1, 1)*torch.cat(mu, dim=-1)
+
+    def mean_and_grad(self, x_test):
+        mu, grad = kernel_mean_and_grad(self.kernel, self.basis(), self.coef, x_test, self.variance,
+                                        lengthscale=self.lengthscale, chunk_size=self.chunk_size)
+        return self.mean_prior + mu, grad
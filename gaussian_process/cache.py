@@ -0,0 +1,69 @@
+import hashlib
+import torch
+from collections import OrderedDict
+
+def tensor_bytes(value):
+    return sum(t.element_size()*t.nelement() for t in value.values() if torch.is_tensor(t))
+
+def fingerprint(x):
+    # content key of a dataset tensor, stable across processes and runs
+    a = x.detach().cpu().contiguous().numpy()
+    return hashlib.sha1(a.tobytes()).hexdigest() + str(a.shape)
+
+def quantize(u, grid_size):
+    # snap u in [-1, 1] onto grid_size evenly spaced points (grid_size=1 keeps only the centre)
+    if grid_size <= 1:
+        return torch.zeros_like(u)
+    half = (grid_size - 1) / 2
+    return torch.round(u*half)/half
+
+class FactorBank:
+    # LRU cache of kernel factorizations shared across epochs, bounded by total tensor bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        # value is a dict of tensors, e.g. {'K': K_train_train, 'L': L}
+        size = tensor_bytes(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= tensor_bytes(self.entries.pop(key))
+        while self.entries and self.nbytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= tensor_bytes(evicted)
+            self.evictions += 1
+        self.entries[key] = value
+        self.nbytes += size
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self.entries),
+                'MB': self.nbytes/1024**2,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits/total if total > 0 else 0.0}
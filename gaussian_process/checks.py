@@ -0,0 +1,146 @@
+import sys
+import torch
+from gaussian_process.GP import GP
+from gaussian_process.sparse import SparseGP
+from gaussian_process.cache import FactorBank
+from gaussian_process.kernels import sq_dist, native_kernel_dict, kernel_mean_and_grad
+
+# Equivalence checks of the closed-form and alternative-solver paths against autograd and a dense
+# Cholesky, on small float64 problems: python -m gaussian_process.checks
+
+KERNELS = [('rbf', {}), ('matern', {'nu': 0.5}), ('matern', {'nu': 1.5}), ('matern', {'nu': 2.5}), ('rq', {})]
+
+failures = []
+
+def check(name, actual, expected, rtol=1e-6, atol=1e-8):
+    ok = torch.allclose(actual, expected, rtol=rtol, atol=atol)
+    error = (actual - expected).abs().max().item()
+    print(f"{'ok  ' if ok else 'FAIL'} {name}: max abs error {error:.2e}")
+    if not ok:
+        failures.append(name)
+
+def make_kernel(name, kwargs, lengthscale):
+    kernel = native_kernel_dict[name](**kwargs)
+    kernel.lengthscale = torch.tensor(lengthscale, dtype=torch.float64)
+    return kernel
+
+def autograd_mean_and_grad(kernel, basis, coef, x, variance):
+    x = x.clone().requires_grad_(True)
+    mu = torch.matmul((variance*kernel.forward(basis, x)).T, coef)
+    return mu.detach(), torch.autograd.grad(mu.sum(), x)[0]
+
+def check_mean_and_grad(generator):
+    N, M, D = 60, 9, 5
+    basis = torch.randn(N, D, generator=generator, dtype=torch.float64)
+    coef = torch.randn(N, generator=generator, dtype=torch.float64)
+    x = torch.randn(M, D, generator=generator, dtype=torch.float64)
+    for name, kwargs in KERNELS:
+        label = name + ''.join(f' {k}={v}' for k, v in kwargs.items())
+        kernel = make_kernel(name, kwargs, 1.3)
+        mu, grad = kernel_mean_and_grad(kernel, basis, coef, x, 0.7, chunk_size=16)
+        mu_ref, grad_ref = autograd_mean_and_grad(kernel, basis, coef, x, 0.7)
+        check(f'mean_and_grad {label}: mean', mu, mu_ref)
+        check(f'mean_and_grad {label}: grad', grad, grad_ref)
+        # batched: one lengthscale, outputscale and coefficient vector per function
+        F = 3
+        lengthscales = torch.tensor([0.8, 1.3, 2.0], dtype=torch.float64)
+        variances = torch.tensor([0.5, 1.0, 1.7], dtype=torch.float64)
+        coefs = torch.randn(F, N, generator=generator, dtype=torch.float64)
+        xs = torch.randn(F, M, D, generator=generator, dtype=torch.float64)
+        mu, grad = kernel_mean_and_grad(kernel, basis, coefs, xs, variances, lengthscale=lengthscales, chunk_size=16)
+        for f in range(F):
+            mu_ref, grad_ref = autograd_mean_and_grad(make_kernel(name, kwargs, float(lengthscales[f])),
+                                                      basis, coefs[f], xs[f], variances[f])
+            check(f'mean_and_grad {label}: batched function {f}', torch.cat([mu[f], grad[f].flatten()]),
+                  torch.cat([mu_ref, grad_ref.flatten()]))
+
+def make_GP(name, kwargs, x_train, y_train, **options):
+    model = GP(device='cpu', x_train=x_train, y_train=y_train, lengthscale=torch.tensor(1.1, dtype=torch.float64),
+               variance=0.9, noise=0.05, mean_prior=0.3, kernel=name, **options)
+    if kwargs:
+        model.kernel = make_kernel(name, kwargs, 1.1)
+    model.set_hyper(lengthscale=model.kernel.lengthscale, variance=model.variance)
+    return model
+
+def check_GP_mean_and_grad(generator):
+    N, M, D = 40, 7, 4
+    x_train = torch.randn(N, D, generator=generator, dtype=torch.float64)
+    y_train = torch.randn(N, generator=generator, dtype=torch.float64)
+    x = torch.randn(M, D, generator=generator, dtype=torch.float64)
+    for name, kwargs in KERNELS:
+        label = name + ''.join(f' {k}={v}' for k, v in kwargs.items())
+        model = make_GP(name, kwargs, x_train, y_train)
+        mu, grad = model.mean_and_grad(x)
+        x_ref = x.clone().requires_grad_(True)
+        mu_ref = model.mean_posterior(x_ref)
+        grad_ref = torch.autograd.grad(mu_ref.sum(), x_ref)[0]
+        check(f'GP.mean_and_grad {label}: mean', mu, mu_ref.detach())
+        check(f'GP.mean_and_grad {label}: grad', grad, grad_ref)
+
+def check_solver(generator, solver, rtol=1e-6, atol=1e-8, **options):
+    # (K + noise*I)^{-1} (y - mean_prior) against a dense torch.linalg.cholesky solve
+    N, D, F = 120, 3, 4
+    x_train = torch.randn(N, D, generator=generator, dtype=torch.float64)
+    Y = torch.randn(N, F, generator=generator, dtype=torch.float64)
+    model = GP(device='cpu', x_train=x_train, y_train=Y[:, 0], lengthscale=torch.tensor(0.9, dtype=torch.float64),
+               variance=1.2, noise=0.05, mean_prior=0.3, solver=solver, **options)
+    K = model.covariance(x_train, x_train) + model.noise*torch.eye(N, dtype=torch.float64)
+    L = torch.linalg.cholesky(K)
+    check(f'{solver} solve: one label vector', model.solve(Y[:, 0]),
+          torch.cholesky_solve((Y[:, :1] - model.mean_prior), L).squeeze(-1), rtol=rtol, atol=atol)
+    check(f'{solver} solve: {F} label vectors', model.solve(Y), torch.cholesky_solve(Y - model.mean_prior, L),
+          rtol=rtol, atol=atol)
+    return model
+
+def check_add_points(generator):
+    # a GP grown with add_points (blockwise factor update, extended distance cache) against one
+    # built from scratch on the grown data
+    N, k, M, D = 80, 15, 25, 3
+    x = torch.randn(N + k, D, generator=generator, dtype=torch.float64)
+    y = torch.randn(N + k, generator=generator, dtype=torch.float64)
+    x_test = torch.randn(M, D, generator=generator, dtype=torch.float64)
+    hypers = dict(lengthscale=torch.tensor(0.9, dtype=torch.float64), variance=1.2, noise=0.05, mean_prior=0.3)
+    bank = FactorBank(max_bytes=1 << 30)
+    for label, options in (('no bank', {}), ('bank', {'bank': bank, 'cache_key': ('grow', N)})):
+        grown = GP(device='cpu', x_train=x[:N], y_train=y[:N], **hypers, **options)
+        grown.set_hyper(lengthscale=grown.kernel.lengthscale, variance=grown.variance)
+        grown.add_points(x[N:], y[N:], cache_key=('grow', N + k) if options else None)
+        scratch = GP(device='cpu', x_train=x, y_train=y, **hypers)
+        scratch.set_hyper(lengthscale=scratch.kernel.lengthscale, variance=scratch.variance)
+        check(f'add_points ({label}): factor', grown.L, scratch.factorize())
+        check(f'add_points ({label}): coef', grown.coef, scratch.coef)
+        check(f'add_points ({label}): variance_posterior', grown.variance_posterior(x_test),
+              scratch.variance_posterior(x_test))
+    # the extended distance cache the bank now holds for the grown data, and a GP built on it
+    check('add_points (bank): sq_dist', bank.get((('grow', N + k), 'sq_dist'))['sq_dist'],
+          sq_dist(x, x, x1_eq_x2=True))
+    cached = GP(device='cpu', x_train=x, y_train=y, bank=bank, cache_key=('grow', N + k), **hypers)
+    cached.set_hyper(lengthscale=cached.kernel.lengthscale, variance=cached.variance)
+    check('add_points (bank): factor from the cached distances', cached.factorize(), scratch.factorize())
+    # SGPR on fixed inducing points
+    inducing_x = x[:20]
+    grown = SparseGP(device='cpu', x_train=x[:N], y_train=y[:N], inducing_x=inducing_x, **hypers)
+    grown.set_hyper(lengthscale=grown.kernel.lengthscale, variance=grown.variance)
+    grown.add_points(x[N:], y[N:])
+    scratch = SparseGP(device='cpu', x_train=x, y_train=y, inducing_x=inducing_x, **hypers)
+    scratch.set_hyper(lengthscale=scratch.kernel.lengthscale, variance=scratch.variance)
+    check('add_points (sparse): coef', grown.coef, scratch.coef)
+    check('add_points (sparse): variance_posterior', grown.variance_posterior(x_test),
+          scratch.variance_posterior(x_test))
+
+def run():
+    generator = torch.Generator().manual_seed(0)
+    check_mean_and_grad(generator)
+    check_GP_mean_and_grad(generator)
+    check_add_points(generator)
+    # the in-place blocked factorization, over several blocks
+    check_solver(generator, 'cholesky', block_size=32)
+    check_solver(generator, 'cg', rtol=1e-5, atol=1e-7, cg_tol=1e-10, cg_tile_size=32, precond_rank=20)
+    check_solver(generator, 'eigh')
+    # small blocks so the factorization and substitutions run across several tiles and workers
+    check_solver(generator, 'distributed', num_workers=2, block_size=32)
+    print(f'{len(failures)} failed' if failures else 'all checks passed')
+    return not failures
+
+if __name__ == '__main__':
+    sys.exit(0 if run() else 1)
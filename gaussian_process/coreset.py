@@ -0,0 +1,102 @@
+import torch
+from gaussian_process.cache import fingerprint
+from gaussian_process.kernels import sq_dist
+from gaussian_process.solvers import pivoted_cholesky
+
+class CoresetSelector:
+    # fit-subset selection over one dataset. 'kcenter' (greedy farthest point) and 'variance'
+    # (greedy maximum posterior variance) produce prefix-consistent orders that are extended
+    # incrementally when a larger subset is requested; 'leverage' samples without replacement
+    # from ridge leverage scores of a rank-r Nystrom approximation, computed once.
+    def __init__(self, x, method='kcenter', kernel_rows=None, variance=1.0, noise=1e-2, leverage_rank=256, seed=0):
+        self.x = x
+        self.method = method
+        self.kernel_rows = kernel_rows
+        self.variance = float(torch.as_tensor(variance).reshape(-1)[0])
+        self.noise = float(torch.as_tensor(noise).reshape(-1)[0])
+        self.leverage_rank = leverage_rank
+        self.seed = seed
+        self.order = []
+        self.state = None
+        self.scores = None
+
+    def extend_kcenter(self, k):
+        x = self.x
+        if self.state is None:
+            first = int(torch.randint(x.shape[0], (1,), generator=torch.Generator().manual_seed(self.seed)))
+            self.order.append(first)
+            self.state = sq_dist(x, x[first:first+1]).squeeze(-1)
+        min_dist = self.state
+        while len(self.order) < k:
+            i = int(torch.argmax(min_dist))
+            self.order.append(i)
+            torch.minimum(min_dist, sq_dist(x, x[i:i+1]).squeeze(-1), out=min_dist)
+
+    def extend_variance(self, k):
+        # pivoted Cholesky continued from the previous pivots; diag is the current posterior variance
+        x = self.x
+        if self.state is None:
+            self.state = [torch.full((x.shape[0],), self.variance, dtype=x.dtype, device=x.device),
+                          torch.empty(0, x.shape[0], dtype=x.dtype, device=x.device)]
+        diag, L = self.state
+        m = len(self.order)
+        if L.shape[0] < k:
+            # grow the factor geometrically so repeated small extensions stay amortized O(kN)
+            L = torch.cat([L, L.new_empty(max(k, 2*L.shape[0]) - L.shape[0], x.shape[0])])
+            self.state[1] = L
+        while m < k:
+            i = int(torch.argmax(diag))
+            pivot = diag[i]
+            if pivot <= 1e-10:
+                break
+            row = self.kernel_rows(x[i:i+1]).squeeze(0)
+            if m > 0:
+                row = row - torch.matmul(L[:m, i], L[:m])
+            L[m] = row/torch.sqrt(pivot)
+            diag.sub_(L[m].pow(2)).clamp_min_(0)
+            self.order.append(i)
+            m += 1
+
+    def leverage_scores(self):
+        # tau_i = l_i^T (L^T L + noise*I)^{-1} l_i for K ~= L L^T
+        if self.scores is None:
+            x = self.x
+            diag = torch.full((x.shape[0],), self.variance, dtype=x.dtype, device=x.device)
+            L = pivoted_cholesky(self.kernel_rows, x, diag, rank=min(self.leverage_rank, x.shape[0]))
+            inner = torch.matmul(L.T, L)
+            inner.diagonal().add_(self.noise)
+            V = torch.cholesky_solve(L.T, torch.linalg.cholesky(inner))
+            self.scores = (L*V.T).sum(1).clamp_min_(1e-12)
+        return self.scores
+
+    def select(self, k, generator=None):
+        k = min(k, self.x.shape[0])
+        with torch.no_grad():
+            if self.method == 'kcenter':
+                self.extend_kcenter(k)
+            elif self.method == 'variance':
+                self.extend_variance(k)
+                if len(self.order) < k:
+                    # the kernel is numerically exhausted: pad with the highest-variance remaining points
+                    diag = self.state[0].clone()
+                    diag[self.order] = -1
+                    extra = torch.argsort(diag, descending=True)[:k - len(self.order)]
+                    return torch.tensor(self.order + extra.tolist(), dtype=torch.long, device=self.x.device)
+            elif self.method == 'leverage':
+                scores = self.leverage_scores().cpu()
+                return torch.multinomial(scores/scores.sum(), k, replacement=False, generator=generator).to(self.x.device)
+            else:
+                raise NotImplementedError(f'Coreset method {self.method} not understood.')
+        return torch.tensor(self.order[:k], dtype=torch.long, device=self.x.device)
+
+# selectors survive across epochs, keyed by dataset content, method and kernel hyperparameters
+coreset_cache = {}
+
+def coreset_selector(x, method, kernel_rows=None, variance=1.0, noise=1e-2, lengthscale=None, max_entries=8, **kwargs):
+    hypers = tuple(float(torch.as_tensor(h).reshape(-1)[0]) for h in (lengthscale, variance, noise)) if method != 'kcenter' else ()
+    key = (fingerprint(x), method, hypers)
+    if key not in coreset_cache:
+        while len(coreset_cache) >= max_entries:
+            del coreset_cache[next(iter(coreset_cache))]
+        coreset_cache[key] = CoresetSelector(x, method, kernel_rows=kernel_rows, variance=variance, noise=noise, **kwargs)
+    return coreset_cache[key]
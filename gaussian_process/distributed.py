@@ -0,0 +1,192 @@
+import os
+import atexit
+import torch
+import torch.multiprocessing as mp
+from gaussian_process.kernels import build_kernel, native_kernel_dict
+
+# Right-looking blocked Cholesky over tiles of one shared-memory matrix. Worker processes attach
+# to the shared buffers once per factorization and then receive lists of tile operations; the
+# main process factorizes the diagonal blocks and acts as the barrier between phases. The kernel
+# is built tile by tile by the workers and overwritten in place by its factor, so a node holds
+# a single N x N matrix and every worker runs its own BLAS pool. Workers are spawned once per
+# process and shared by every DistributedCholesky with the same num_workers, and they drop the
+# shared buffers as soon as a factorization or solve is done.
+
+def tile(A, rows, cols):
+    return A[rows[0]:rows[1], cols[0]:cols[1]]
+
+def run_ops(buffers, ops, kernel):
+    A = buffers.get('A')
+    for op in ops:
+        name = op[0]
+        if name == 'kernel':
+            # variance*k(x_I, x_J) (+ noise on diagonal tiles)
+            _, rows, cols, variance, noise = op
+            x = buffers['x']
+            K = build_kernel(kernel, x[rows[0]:rows[1]], x[cols[0]:cols[1]], variance=variance)
+            if rows == cols:
+                K.diagonal().add_(noise)
+            tile(A, rows, cols).copy_(K)
+        elif name == 'trsm':
+            # A_ik <- A_ik L_kk^{-T}
+            _, rows, diag = op
+            L_kk = tile(A, diag, diag)
+            panel = tile(A, rows, diag)
+            panel.copy_(torch.linalg.solve_triangular(L_kk.T, panel, upper=True, left=False))
+        elif name == 'update':
+            # A_ij <- A_ij - L_ik L_jk^T
+            _, rows, cols, diag = op
+            tile(A, rows, cols).sub_(torch.matmul(tile(A, rows, diag), tile(A, cols, diag).T))
+        elif name == 'forward':
+            # b_i <- b_i - L_ik x_k
+            _, rows, diag = op
+            b = buffers['b']
+            b[rows[0]:rows[1]].sub_(torch.matmul(tile(A, rows, diag), b[diag[0]:diag[1]]))
+        elif name == 'backward':
+            # b_i <- b_i - L_ki^T x_k
+            _, rows, diag = op
+            b = buffers['b']
+            b[rows[0]:rows[1]].sub_(torch.matmul(tile(A, diag, rows).T, b[diag[0]:diag[1]]))
+        else:
+            raise NotImplementedError(f'Operation {name} not understood.')
+
+def worker_loop(tasks, results, num_threads):
+    torch.set_num_threads(num_threads)
+    buffers = {}
+    kernel = None
+    while True:
+        message = tasks.get()
+        if message is None:
+            break
+        try:
+            if message[0] == 'detach':
+                buffers = {}
+            elif message[0] == 'attach':
+                buffers = message[1]
+                if message[2] is not None:
+                    kernel_name, lengthscale = message[2]
+                    kernel = native_kernel_dict[kernel_name]()
+                    kernel.lengthscale = torch.tensor(lengthscale, dtype=buffers['A'].dtype)
+            else:
+                run_ops(buffers, message[1], kernel)
+            results.put((True, None))
+        except Exception as e:
+            results.put((False, repr(e)))
+
+class WorkerPool:
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.workers = None
+
+    def start(self):
+        if self.workers is not None:
+            return
+        # spawned rather than forked: the parent may already run BLAS and dataloader threads
+        ctx = mp.get_context('spawn')
+        threads = max(1, (os.cpu_count() or 1)//self.num_workers)
+        self.results = ctx.Queue()
+        self.tasks = [ctx.Queue() for _ in range(self.num_workers)]
+        self.workers = [ctx.Process(target=worker_loop, args=(tasks, self.results, threads), daemon=True)
+                        for tasks in self.tasks]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        if self.workers is None:
+            return
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = None
+
+    def broadcast(self, message):
+        for tasks in self.tasks:
+            tasks.put(message)
+        self.wait(len(self.tasks))
+
+    def scatter(self, ops):
+        # round-robin the ops over the workers and block until all of them are done
+        if len(ops) == 0:
+            return
+        num_busy = min(len(ops), self.num_workers)
+        for w in range(num_busy):
+            self.tasks[w].put(('ops', ops[w::self.num_workers]))
+        self.wait(num_busy)
+
+    def wait(self, num_messages):
+        errors = []
+        for _ in range(num_messages):
+            ok, error = self.results.get()
+            if not ok:
+                errors.append(error)
+        if errors:
+            raise RuntimeError(f'distributed Cholesky worker failed: {errors[0]}')
+
+pools = {}
+
+def worker_pool(num_workers):
+    # one pool per process and worker count, closed at exit
+    if num_workers not in pools:
+        pools[num_workers] = WorkerPool(num_workers)
+        atexit.register(pools[num_workers].close)
+    pool = pools[num_workers]
+    pool.start()
+    return pool
+
+class DistributedCholesky:
+    def __init__(self, num_workers=None, block_size=2048):
+        self.num_workers = num_workers if num_workers is not None else max(1, min(8, (os.cpu_count() or 1)//2))
+        self.block_size = block_size
+
+    def blocks(self, N):
+        return [(start, min(start + self.block_size, N)) for start in range(0, N, self.block_size)]
+
+    def factorize(self, kernel_name, x, lengthscale, variance, noise, A=None):
+        # lower Cholesky factor of variance*k(x, x) + noise*I, built and factorized in shared memory
+        pool = worker_pool(self.num_workers)
+        x = x.detach().cpu().contiguous().share_memory_()
+        N = x.shape[0]
+        if A is None or A.shape != (N, N) or A.dtype != x.dtype:
+            A = torch.empty(N, N, dtype=x.dtype).share_memory_()
+        pool.broadcast(('attach', {'A': A, 'x': x}, (kernel_name, float(lengthscale))))
+        try:
+            blocks = self.blocks(N)
+            pool.scatter([('kernel', rows, cols, float(variance), float(noise))
+                          for i, rows in enumerate(blocks) for cols in blocks[:i+1]])
+            for k, diag in enumerate(blocks):
+                L_kk = tile(A, diag, diag)
+                L_kk.copy_(torch.linalg.cholesky(L_kk))
+                pool.scatter([('trsm', rows, diag) for rows in blocks[k+1:]])
+                pool.scatter([('update', rows, cols, diag)
+                              for i, rows in enumerate(blocks[k+1:]) for cols in blocks[k+1:k+2+i]])
+        finally:
+            pool.broadcast(('detach',))
+        # drop the stale upper triangle one block row at a time
+        for rows in blocks:
+            A[rows[0]:rows[1], rows[1]:].zero_()
+            tile(A, rows, rows).tril_()
+        return A
+
+    def solve(self, L, b):
+        # (L L^T)^{-1} b by blocked forward and backward substitution; b is (N,) or (N, F)
+        pool = worker_pool(self.num_workers)
+        device = b.device
+        squeeze = b.dim() == 1
+        b = (b.unsqueeze(-1) if squeeze else b).detach().to('cpu', L.dtype).clone().share_memory_()
+        pool.broadcast(('attach', {'A': L, 'b': b}, None))
+        try:
+            blocks = self.blocks(L.shape[0])
+            for k, diag in enumerate(blocks):
+                b[diag[0]:diag[1]] = torch.linalg.solve_triangular(tile(L, diag, diag), b[diag[0]:diag[1]], upper=False)
+                pool.scatter([('forward', rows, diag) for rows in blocks[k+1:]])
+            for k in range(len(blocks) - 1, -1, -1):
+                diag = blocks[k]
+                b[diag[0]:diag[1]] = torch.linalg.solve_triangular(tile(L, diag, diag).T, b[diag[0]:diag[1]], upper=True)
+                pool.scatter([('backward', rows, diag) for rows in blocks[:k]])
+        finally:
+            pool.broadcast(('detach',))
+        b = b.to(device)
+        return b.squeeze(-1) if squeeze else b
@@ -0,0 +1,94 @@
+import math
+import torch
+from gaussian_process.kernels import sq_dist, native_kernel_dict
+
+def log_uniform(low, high, num, generator):
+    u = torch.rand(num, generator=generator, dtype=torch.float64)
+    return math.log(low) + u*(math.log(high) - math.log(low))
+
+def batched_log_marginal_likelihood(kernel, sq_dists, y, log_params, mean_prior=0.0, jitter=1e-6):
+    # log N(y | m, s^2 k(d^2/l^2) + noise*I) for R hyperparameter settings at once;
+    # log_params is (R, 3) = log(lengthscale, outputscale, noise), the kernel stack is (R, N, N)
+    lengthscale, variance, noise = log_params.exp().unbind(-1)
+    N = y.shape[0]
+    K = kernel.transform(sq_dists/lengthscale.pow(2).reshape(-1, 1, 1))
+    K = variance.reshape(-1, 1, 1)*K
+    eye = torch.eye(N, dtype=K.dtype, device=K.device)
+    K = K + (noise + jitter*variance).reshape(-1, 1, 1)*eye
+    L, info = torch.linalg.cholesky_ex(K)
+    ok = info == 0
+    if not ok.all():
+        # restarts that left the PD region are swapped for the identity so they carry no gradient
+        L = torch.linalg.cholesky(torch.where(ok.reshape(-1, 1, 1), K, eye))
+    b = (y - mean_prior).reshape(1, -1, 1).expand(K.shape[0], -1, -1)
+    alpha = torch.linalg.solve_triangular(L, b, upper=False)
+    lml = -0.5*alpha.pow(2).sum((-2, -1)) - torch.log(L.diagonal(dim1=-2, dim2=-1)).sum(-1) - 0.5*N*math.log(2*math.pi)
+    return torch.where(ok, lml, torch.full_like(lml, -math.inf)), ok
+
+def fit_hyperparameters(x, y, kernel='rbf', mean_prior=0.0, num_restarts=16, num_steps=100, lr=0.05,
+                        optimizer='adam', lengthscale_range=(0.1, 10.0), outputscale_range=(0.1, 10.0),
+                        noise_range=(1e-6, 1e-1), learn_noise=True, init=None, seed=0):
+    # multi-start type-II maximum likelihood for (lengthscale, outputscale, noise); all restarts
+    # share one squared-distance matrix and are optimized as a single (R, N, N) batch.
+    # init=(lengthscale, outputscale, noise) pins restart 0 to a known setting, e.g. the config's.
+    generator = torch.Generator().manual_seed(seed)
+    bounds = torch.tensor([lengthscale_range, outputscale_range, noise_range], dtype=torch.float64).log()
+    log_params = torch.stack([log_uniform(*lengthscale_range, num_restarts, generator),
+                              log_uniform(*outputscale_range, num_restarts, generator),
+                              log_uniform(*noise_range, num_restarts, generator)], dim=-1)
+    if init is not None:
+        log_params[0] = torch.tensor(init, dtype=torch.float64).clamp_min(1e-12).log()
+    if not learn_noise:
+        log_params[:, 2] = log_params[0, 2]
+    bounds = bounds.to(device=x.device, dtype=x.dtype)
+    log_params = log_params.to(device=x.device, dtype=x.dtype).requires_grad_(True)
+
+    native_kernel = native_kernel_dict[kernel]()
+    with torch.no_grad():
+        sq_dists = sq_dist(x, x, x1_eq_x2=True)
+
+    best_lml = torch.full((num_restarts,), -math.inf, dtype=x.dtype, device=x.device)
+    best_params = log_params.detach().clone()
+
+    def evaluate():
+        lml, ok = batched_log_marginal_likelihood(native_kernel, sq_dists, y, log_params, mean_prior=mean_prior)
+        with torch.no_grad():
+            improved = lml > best_lml
+            best_lml[improved] = lml[improved]
+            best_params[improved] = log_params[improved]
+        # restarts are independent, so the summed objective optimizes each one separately
+        return -torch.where(ok, lml, torch.zeros_like(lml)).sum()/num_restarts
+
+    if optimizer == 'lbfgs':
+        opt = torch.optim.LBFGS([log_params], lr=lr, max_iter=num_steps, line_search_fn='strong_wolfe')
+        def closure():
+            opt.zero_grad()
+            loss = evaluate()
+            loss.backward()
+            if not learn_noise:
+                log_params.grad[:, 2] = 0
+            return loss
+        opt.step(closure)
+        with torch.no_grad():
+            log_params.copy_(torch.maximum(torch.minimum(log_params, bounds[:, 1]), bounds[:, 0]))
+    elif optimizer == 'adam':
+        opt = torch.optim.Adam([log_params], lr=lr)
+        for _ in range(num_steps):
+            opt.zero_grad()
+            loss = evaluate()
+            loss.backward()
+            if not learn_noise:
+                log_params.grad[:, 2] = 0
+            opt.step()
+            with torch.no_grad():
+                log_params.copy_(torch.maximum(torch.minimum(log_params, bounds[:, 1]), bounds[:, 0]))
+    else:
+        raise NotImplementedError(f'Optimizer {optimizer} not understood.')
+    with torch.no_grad():
+        evaluate()
+
+    best = int(torch.argmax(best_lml))
+    lengthscale, outputscale, noise = torch.maximum(torch.minimum(best_params[best], bounds[:, 1]), bounds[:, 0]).exp().tolist()
+    return {'lengthscale': lengthscale, 'outputscale': outputscale, 'noise': noise,
+            'lml': float(best_lml[best]), 'restart': best,
+            'restart_lml': best_lml.tolist()}
@@ -0,0 +1,165 @@
+import math
+import torch
+
+# below this many kernel entries torch.cdist is used; above it the matmul expansion writes
+# straight into the output buffer
+CDIST_MAX_ENTRIES = 2**20
+
+def sq_dist(x1, x2, x1_eq_x2=False, out=None):
+    # ||x1_i - x2_j||^2 through the matmul expansion, centred like gpytorch for stability
+    adjustment = x1.mean(-2, keepdim=True)
+    x1 = x1 - adjustment
+    x2 = x1 if x1_eq_x2 else x2 - adjustment
+    x1_norm = x1.pow(2).sum(-1, keepdim=True)
+    x2_norm = x1_norm if x1_eq_x2 else x2.pow(2).sum(-1, keepdim=True)
+    res = torch.matmul(x1, x2.transpose(-2, -1), out=out).mul_(-2).add_(x1_norm).add_(x2_norm.transpose(-2, -1))
+    if x1_eq_x2:
+        res.diagonal(dim1=-2, dim2=-1).fill_(0)
+    return res.clamp_min_(0)
+
+class Kernel:
+    # unit-variance stationary kernel k(s) of the scaled squared distance s = ||(x1 - x2)/lengthscale||^2
+    def __init__(self):
+        self.lengthscale = torch.tensor(1.0)
+
+    def to(self, device):
+        self.lengthscale = torch.as_tensor(self.lengthscale).to(device)
+        return self
+
+    def scaled_sq_dist(self, x1, x2, x1_eq_x2=False, out=None):
+        return sq_dist(x1/self.lengthscale, x2/self.lengthscale, x1_eq_x2=x1_eq_x2, out=out)
+
+    def forward(self, x1, x2):
+        # differentiable, allocating path used by mean_posterior
+        return self.transform(self.scaled_sq_dist(x1, x2))
+
+    def transform(self, s):
+        raise NotImplementedError
+
+    def transform_(self, s):
+        raise NotImplementedError
+
+    def value_and_derivative(self, s):
+        # k(s) and dk/ds, used for closed-form input gradients
+        raise NotImplementedError
+
+class RBFKernel(Kernel):
+    def transform(self, s):
+        return torch.exp(-0.5*s)
+
+    def value_and_derivative(self, s):
+        value = torch.exp(-0.5*s)
+        return value, value*(-0.5)
+
+    def transform_(self, s):
+        return s.mul_(-0.5).exp_()
+
+class MaternKernel(Kernel):
+    def __init__(self, nu=2.5):
+        super().__init__()
+        if nu not in (0.5, 1.5, 2.5):
+            raise NotImplementedError(f'Matern nu={nu} is not supported')
+        self.nu = nu
+
+    def transform(self, s):
+        d = torch.sqrt(s.clamp_min(1e-30)*(2*self.nu))
+        exp_component = torch.exp(-d)
+        if self.nu == 0.5:
+            return exp_component
+        if self.nu == 1.5:
+            return (1 + d)*exp_component
+        return (1 + d + d.pow(2)/3)*exp_component
+
+    def transform_(self, s, chunk_size=1024):
+        s.clamp_min_(1e-30).mul_(2*self.nu).sqrt_()
+        if self.nu == 0.5:
+            return s.neg_().exp_()
+        # polynomial factor times exp(-d), a row chunk at a time to bound the temporary
+        for start in range(0, s.shape[-2], chunk_size):
+            d = s[..., start:start+chunk_size, :]
+            exp_component = torch.exp(-d)
+            if self.nu == 1.5:
+                d.add_(1)
+            else:
+                d.copy_(torch.addcmul(d + 1, d, d, value=1/3))
+            d.mul_(exp_component)
+        return s
+
+    def value_and_derivative(self, s):
+        d = torch.sqrt(s.clamp_min(1e-30)*(2*self.nu))
+        exp_component = torch.exp(-d)
+        if self.nu == 0.5:
+            return exp_component, exp_component*(-0.5)/d
+        if self.nu == 1.5:
+            return (1 + d)*exp_component, exp_component*(-1.5)
+        return (1 + d + d.pow(2)/3)*exp_component, (1 + d)*exp_component*(-5/6)
+
+class RQKernel(Kernel):
+    # alpha defaults to gpytorch's initial softplus(0) so the two implementations agree
+    def __init__(self, alpha=math.log(2)):
+        super().__init__()
+        self.alpha = alpha
+
+    def transform(self, s):
+        return (1 + s/(2*self.alpha)).pow(-self.alpha)
+
+    def transform_(self, s):
+        return s.div_(2*self.alpha).add_(1).pow_(-self.alpha)
+
+    def value_and_derivative(self, s):
+        base = 1 + s/(2*self.alpha)
+        value = base.pow(-self.alpha)
+        return value, value*(-0.5)/base
+
+native_kernel_dict = {'rbf': RBFKernel, 'matern': MaternKernel, 'rq': RQKernel}
+
+def build_kernel(kernel, x1, x2=None, variance=1.0, jitter=None, out=None, sq_dists=None, method='auto'):
+    # variance*k(x1, x2) (+ jitter on the diagonal) written into a single buffer; scaling,
+    # exponentiation and jitter are all applied in place. sq_dists are cached unscaled squared
+    # distances and assume an isotropic (scalar) lengthscale.
+    x1_eq_x2 = x2 is None
+    x2 = x1 if x1_eq_x2 else x2
+    with torch.no_grad():
+        if sq_dists is not None:
+            lengthscale = torch.as_tensor(kernel.lengthscale, device=sq_dists.device).reshape(-1)[0]
+            if out is None:
+                out = torch.empty_like(sq_dists)
+            torch.div(sq_dists, lengthscale.pow(2), out=out)
+        elif method == 'cdist' or (method == 'auto' and x1.shape[-2]*x2.shape[-2] <= CDIST_MAX_ENTRIES):
+            dist = torch.cdist(x1/kernel.lengthscale, x2/kernel.lengthscale).pow_(2)
+            out = dist if out is None else out.copy_(dist)
+        else:
+            out = kernel.scaled_sq_dist(x1, x2, x1_eq_x2=x1_eq_x2, out=out)
+        kernel.transform_(out)
+        out.mul_(variance)
+        if jitter is not None:
+            out.diagonal(dim1=-2, dim2=-1).add_(jitter)
+    return out
+
+def kernel_mean_and_grad(kernel, basis, coef, x, variance, lengthscale=None, chunk_size=4096):
+    # sum_i coef_i*variance*k(x, basis_i) and its gradient w.r.t. x in one graph-free pass,
+    # chunked over basis rows. For s = ||(x - xi)/l||^2, d/dx k = k'(s)*2(x - xi)/l^2.
+    # Batched when coef is (F, N): x is then (F, M, D), basis (N, D) or (F, N, D), and
+    # lengthscale/variance hold one value per function.
+    with torch.no_grad():
+        lengthscale = torch.as_tensor(kernel.lengthscale if lengthscale is None else lengthscale, device=x.device)
+        variance = torch.as_tensor(variance, device=x.device)
+        mu_variance = variance
+        if coef.dim() == 2:
+            lengthscale = lengthscale.reshape(-1, 1, 1)
+            variance = variance.reshape(-1, 1, 1)
+            mu_variance = variance.reshape(-1, 1)
+        x_scaled = x/lengthscale
+        mu = torch.zeros(x.shape[:-1], dtype=x.dtype, device=x.device)
+        weight_sum = torch.zeros_like(mu)
+        weighted_basis = torch.zeros_like(x)
+        for start in range(0, basis.shape[-2], chunk_size):
+            basis_chunk = basis[..., start:start+chunk_size, :]
+            coef_chunk = coef[..., start:start+chunk_size]
+            value, derivative = kernel.value_and_derivative(sq_dist(x_scaled, basis_chunk/lengthscale))
+            mu.add_(torch.matmul(value, coef_chunk.unsqueeze(-1)).squeeze(-1))
+            derivative.mul_(coef_chunk.unsqueeze(-2))
+            weight_sum.add_(derivative.sum(-1))
+            weighted_basis.add_(torch.matmul(derivative, basis_chunk))
+        grad = (weight_sum.unsqueeze(-1)*x - weighted_basis).mul_(2*variance/lengthscale.pow(2))
+    return mu.mul_(mu_variance), grad
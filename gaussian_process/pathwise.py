@@ -0,0 +1,96 @@
+import math
+import torch
+from gaussian_process.kernels import kernel_mean_and_grad
+
+def spectral_frequencies(gp, num_features):
+    # frequencies of the kernel's spectral density, scaled by the lengthscale
+    x = gp.x_train
+    D = x.shape[1]
+    lengthscale = torch.as_tensor(gp.kernel.lengthscale, device=x.device).reshape(-1)[0]
+    z = torch.randn(num_features, D, dtype=x.dtype, device=x.device)
+    if gp.kernel_name == 'rbf':
+        return z/lengthscale
+    if gp.kernel_name == 'matern':
+        # multivariate Student-t with 2*nu degrees of freedom
+        nu = getattr(gp.kernel, 'nu', 2.5)
+        u = torch.distributions.Gamma(nu, nu).sample((num_features, 1)).to(device=x.device, dtype=x.dtype)
+        return z/(lengthscale*torch.sqrt(u))
+    if gp.kernel_name == 'rq':
+        # scale mixture of RBFs with Gamma(alpha, alpha) precision
+        alpha = float(getattr(gp.kernel, 'alpha', math.log(2)))
+        tau = torch.distributions.Gamma(alpha, alpha).sample((num_features, 1)).to(device=x.device, dtype=x.dtype)
+        return z*torch.sqrt(tau)/lengthscale
+    raise NotImplementedError(f'Random Fourier features for kernel {gp.kernel_name} are not implemented')
+
+class RandomFourierFeatures:
+    # phi(x) with phi(x) phi(x')^T ~= variance*k(x, x')
+    def __init__(self, gp, num_features=1024):
+        self.num_features = num_features
+        self.omega = spectral_frequencies(gp, num_features)
+        self.phase = 2*math.pi*torch.rand(num_features, dtype=gp.x_train.dtype, device=gp.x_train.device)
+        self.scale = torch.sqrt(2*torch.as_tensor(gp.variance, device=gp.x_train.device).reshape(-1)[0]/num_features)
+
+    def __call__(self, x):
+        return self.scale*torch.cos(torch.matmul(x, self.omega.T) + self.phase)
+
+    def value_and_grad(self, x, weights):
+        # phi(x) w and its gradient w.r.t. x for a single weight vector
+        with torch.no_grad():
+            projection = torch.matmul(x, self.omega.T) + self.phase
+            value = self.scale*torch.matmul(torch.cos(projection), weights)
+            grad = -self.scale*torch.matmul(torch.sin(projection)*weights, self.omega)
+        return value, grad
+
+class PathwiseSampler:
+    # Matheron's rule: f_s(x) = m + phi(x) w_s + k(x, basis) v_s with
+    # v_s = (K + noise*I)^{-1} (y_s - m - phi(X) w_s - eps_s), solved against the GP's cached factor.
+    # y may be (N,) shared by all samples or (N, S) with one label vector per sample.
+    def __init__(self, gp, y=None, num_samples=1, num_features=1024, chunk_size=4096):
+        self.gp = gp
+        y = gp.y_train if y is None else y
+        if y.dim() == 2:
+            num_samples = y.shape[1]
+        self.num_samples = num_samples
+        self.features = RandomFourierFeatures(gp, num_features)
+        x = gp.x_train
+        with torch.no_grad():
+            self.weights = torch.randn(num_features, num_samples, dtype=x.dtype, device=x.device)
+            prior_train = torch.cat([torch.matmul(self.features(x[start:start+chunk_size]), self.weights)
+                                     for start in range(0, x.shape[0], chunk_size)])
+            eps = torch.sqrt(torch.as_tensor(gp.noise))*torch.randn_like(prior_train)
+            target = (y.unsqueeze(-1) if y.dim() == 1 else y) - prior_train - eps
+            self.coef = gp.solve(target)
+
+    def __call__(self, x, index=None):
+        # (M, S) values for every sample, or (M,) for one sample
+        weights = self.weights if index is None else self.weights[:, index]
+        coef = self.coef if index is None else self.coef[:, index]
+        K_basis_x = self.gp.variance*self.gp.kernel.forward(self.gp.basis(), x)
+        return self.gp.mean_prior + torch.matmul(self.features(x), weights) + torch.matmul(K_basis_x.T, coef)
+
+    def function(self, index):
+        return PathwiseFunction(self, index)
+
+    def mean_and_grad(self, x, index):
+        gp = self.gp
+        prior, prior_grad = self.features.value_and_grad(x, self.weights[:, index])
+        if gp.kernel_impl == 'native':
+            update, update_grad = kernel_mean_and_grad(gp.kernel, gp.basis(), self.coef[:, index], x, gp.variance)
+            return gp.mean_prior + prior + update, prior_grad + update_grad
+        x = x.detach().requires_grad_(True)
+        with torch.enable_grad():
+            update = torch.matmul((gp.variance*gp.kernel.forward(gp.basis(), x)).T, self.coef[:, index])
+            update_grad = torch.autograd.grad(update.sum(), x)[0]
+        return gp.mean_prior + prior + update.detach(), prior_grad + update_grad
+
+class PathwiseFunction:
+    # one posterior sample with the GP's mean_posterior interface, so the ascent loop can use it as is
+    def __init__(self, sampler, index):
+        self.sampler = sampler
+        self.index = index
+
+    def mean_posterior(self, x_test):
+        return self.sampler(x_test, index=self.index)
+
+    def mean_and_grad(self, x_test):
+        return self.sampler.mean_and_grad(x_test, self.index)
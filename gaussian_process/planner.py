@@ -0,0 +1,61 @@
+EXACT_BACKENDS = ('cholesky', 'distributed', 'cg')
+APPROX_BACKENDS = ('sparse',)
+# relative cost of moving the same flops through worker processes instead of one BLAS call
+DISTRIBUTED_OVERHEAD = 1.25
+
+def estimate_backends(N, D, num_rhs=1, dtype_bytes=4, cache_sq_dist=True, tile_size=1024, precond_rank=100,
+                      cg_iters=100, num_inducing=512, num_workers=4, block_size=2048):
+    # peak bytes and flops of building the training kernel, factorizing/solving it and solving
+    # num_rhs label vectors, per backend
+    F = num_rhs
+    data = N*D + 2*N*F
+    kernel_flops = N*N if cache_sq_dist else 2*N*N*D
+    M = min(num_inducing, N)
+    rank = min(precond_rank, N)
+    tile = min(tile_size, N)
+    estimates = {
+        # K factorized in place by blocks, plus the distance cache and one diagonal and panel block
+        'cholesky': {'bytes': dtype_bytes*(N*N*(2 if cache_sq_dist else 1) + 2*min(block_size, N)**2 + data),
+                     'flops': kernel_flops + N**3/3 + 2*N*N*F},
+        # one shared matrix factorized in place, plus a few tiles per worker
+        'distributed': {'bytes': dtype_bytes*(N*N + 3*num_workers*block_size*block_size + data),
+                        'flops': (2*N*N*D + N**3/3 + 2*N*N*F)*DISTRIBUTED_OVERHEAD},
+        # one kernel tile, the pivoted Cholesky preconditioner and the CG state vectors
+        'cg': {'bytes': dtype_bytes*(tile*N + N*rank + 6*N*F + data),
+               'flops': rank*N*(D + rank) + cg_iters*2*N*N*(D + F)},
+        # K_zx, A and the M x M factors
+        'sparse': {'bytes': dtype_bytes*(2*N*M + 3*M*M + data),
+                   'flops': 2*N*M*D + N*M*M + M**3/3 + 2*N*M*F},
+    }
+    return estimates
+
+def posterior_tile_mb(num_test, num_basis, free_bytes, dtype_bytes=4):
+    # None if the whole (num_test, num_basis) cross-kernel fits, else a tile budget within free_bytes
+    if num_test*num_basis*dtype_bytes <= free_bytes:
+        return None
+    return max(free_bytes, 64*num_basis*dtype_bytes)/1024**2
+
+def plan_backend(N, D, memory_budget_mb, num_rhs=1, num_test=0, allow_approx=False, dtype_bytes=4, **kwargs):
+    # fastest backend whose estimated peak fits the budget; exact backends unless allow_approx.
+    # Falls back to the smallest footprint when nothing fits.
+    budget = memory_budget_mb*1024**2
+    estimates = estimate_backends(N, D, num_rhs=num_rhs, dtype_bytes=dtype_bytes, **kwargs)
+    candidates = EXACT_BACKENDS + (APPROX_BACKENDS if allow_approx else ())
+    fitting = [name for name in candidates if estimates[name]['bytes'] <= budget]
+    if fitting:
+        backend = min(fitting, key=lambda name: estimates[name]['flops'])
+    else:
+        backend = min(candidates, key=lambda name: estimates[name]['bytes'])
+    num_basis = min(kwargs.get('num_inducing', 512), N) if backend == 'sparse' else N
+    free_bytes = max(budget - estimates[backend]['bytes'], 0)
+    return {'backend': backend, 'fits': bool(fitting), 'N': N, 'D': D, 'budget_mb': memory_budget_mb,
+            'tile_memory_mb': posterior_tile_mb(num_test, num_basis, free_bytes, dtype_bytes),
+            'estimates': estimates}
+
+def format_plan(plan):
+    lines = [f"GP planner: N={plan['N']} D={plan['D']} budget={plan['budget_mb']:.0f}MB -> {plan['backend']}"
+             + ('' if plan['fits'] else ' (nothing fits, smallest footprint)')
+             + ('' if plan['tile_memory_mb'] is None else f", posterior tiles of {plan['tile_memory_mb']:.1f}MB")]
+    for name, estimate in plan['estimates'].items():
+        lines.append(f"    {name:<12} peak {estimate['bytes']/1024**2:10.1f}MB  {estimate['flops']:.2e} flop")
+    return '\n'.join(lines)
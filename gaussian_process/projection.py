@@ -0,0 +1,48 @@
+import torch
+
+class Projection:
+    # affine map to k dimensions, z = (x - mean) W with orthonormal columns W (D, k)
+    def __init__(self, mean, components):
+        self.mean = mean
+        self.components = components
+
+    @property
+    def dim(self):
+        return self.components.shape[1]
+
+    def project(self, x):
+        return torch.matmul(x - self.mean, self.components)
+
+    def lift(self, z, x_ref=None):
+        # back to D dimensions; with x_ref the move z - project(x_ref) is added to the original
+        # design, so the part of x_ref outside the subspace is kept instead of discarded
+        if x_ref is None:
+            return torch.matmul(z, self.components.T) + self.mean
+        return x_ref + torch.matmul(z - self.project(x_ref), self.components.T)
+
+def pca_projection(x, dim):
+    with torch.no_grad():
+        mean = x.mean(0)
+        xc = x - mean
+        # eigendecomposition of the D x D covariance instead of an SVD of the N x D data
+        evals, evecs = torch.linalg.eigh(torch.matmul(xc.T, xc)/x.shape[0])
+        order = torch.argsort(evals, descending=True)[:dim]
+        projection = Projection(mean, evecs[:, order].contiguous())
+        projection.explained_variance_ratio = float(evals[order].clamp_min(0).sum()/evals.clamp_min(0).sum().clamp_min(1e-30))
+    return projection
+
+def random_projection(x, dim, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        gaussian = torch.randn(x.shape[1], dim, generator=generator, dtype=torch.float64)
+        components, _ = torch.linalg.qr(gaussian)
+        projection = Projection(x.mean(0), components.to(device=x.device, dtype=x.dtype))
+    return projection
+
+def build_projection(x, method='pca', dim=32, seed=0):
+    dim = min(dim, x.shape[1])
+    if method == 'pca':
+        return pca_projection(x, dim)
+    if method == 'random':
+        return random_projection(x, dim, seed=seed)
+    raise NotImplementedError(f'Projection method {method} not understood.')
@@ -0,0 +1,162 @@
+import os
+import math
+import hashlib
+import torch
+from gaussian_process.batch import BatchGP
+from gaussian_process.cache import fingerprint
+from gaussian_process.kernels import sq_dist
+
+# Pseudo-labellers fill y_train[num_samples+1:] for every function before the refit. Both engines
+# take (x_train, y_train, num_samples, lengthscales, variances) and return one (N_unlabelled,)
+# label vector per function.
+
+class GPPseudoLabeller:
+    # posterior mean of the base GP under each function's perturbed hyperparameters
+    def __init__(self, base_GP_Model, batched=False):
+        self.base_GP_Model = base_GP_Model
+        self.batched = batched
+
+    def __call__(self, x_train, y_train, num_samples, lengthscales, variances):
+        gp = self.base_GP_Model
+        if self.batched:
+            base_batch = BatchGP(device=gp.device,
+                                 x_train=gp.x_train,
+                                 y_train=gp.y_train,
+                                 lengthscale=torch.cat([l.detach().reshape(-1) for l in lengthscales]),
+                                 variance=torch.cat([v.detach().reshape(-1) for v in variances]),
+                                 noise=gp.noise,
+                                 mean_prior=gp.mean_prior,
+                                 kernel=gp.kernel_name)
+            base_batch.set_hyper(lengthscale=base_batch.lengthscale, variance=base_batch.variance)
+            return list(base_batch.mean_posterior(x_train[num_samples+1:]))
+        y_preds = []
+        for lengthscale, variance in zip(lengthscales, variances):
+            gp.set_hyper(lengthscale=lengthscale, variance=variance)
+            y_preds.append(gp.mean_posterior(x_train[num_samples+1:]))
+        return y_preds
+
+def rp_tree_leaves(x, leaf_size, generator):
+    # one random-projection tree, split level by level at the median of a random direction per
+    # node; returns the leaf id of every point. depth = ceil(log2(N/leaf_size)), O(N D) per level.
+    N = x.shape[0]
+    leaf = torch.zeros(N, dtype=torch.long, device=x.device)
+    depth = max(0, math.ceil(math.log2(max(N/leaf_size, 1))))
+    for level in range(depth):
+        directions = torch.randn(2**level, x.shape[1], generator=generator).to(device=x.device, dtype=x.dtype)
+        projection = (x*directions[leaf]).sum(-1)
+        # sort by (leaf, projection) and send the lower half of every leaf to the left child
+        order = torch.argsort(projection)
+        order = order[torch.argsort(leaf[order], stable=True)]
+        counts = torch.bincount(leaf, minlength=2**level)
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.empty_like(leaf)
+        rank[order] = torch.arange(N, device=x.device) - starts[leaf[order]]
+        leaf = 2*leaf + (rank >= (counts[leaf] + 1)//2).long()
+    return leaf
+
+def leaf_neighbors(x, leaf, num_neighbors, chunk_size=4096):
+    # exact kNN inside every leaf, with the leaves padded into one (num_leaves, size, D) batch
+    N = x.shape[0]
+    order = torch.argsort(leaf, stable=True)
+    num_leaves = int(leaf.max()) + 1
+    counts = torch.bincount(leaf, minlength=num_leaves)
+    starts = torch.cumsum(counts, 0) - counts
+    size = int(counts.max())
+    members = torch.full((num_leaves, size), -1, dtype=torch.long, device=x.device)
+    sorted_leaf = leaf[order]
+    members[sorted_leaf, torch.arange(N, device=x.device) - starts[sorted_leaf]] = order
+    k = min(num_neighbors, size - 1)
+    indices = torch.empty(N, max(k, 0), dtype=torch.long, device=x.device)
+    dists = torch.empty(N, max(k, 0), dtype=x.dtype, device=x.device)
+    if k <= 0:
+        return indices, dists
+    leaves_per_chunk = max(1, chunk_size//size)
+    for start in range(0, num_leaves, leaves_per_chunk):
+        block = members[start:start+leaves_per_chunk]
+        valid = block >= 0
+        points = x[block.clamp_min(0)]
+        d = sq_dist(points, points)
+        d.masked_fill_(~valid.unsqueeze(-2), math.inf)
+        d.diagonal(dim1=-2, dim2=-1).fill_(math.inf)
+        nearest_dists, nearest = torch.topk(d, k, dim=-1, largest=False)
+        nearest = torch.gather(block.unsqueeze(1).expand(-1, size, -1), 2, nearest)
+        indices[block[valid]] = nearest[valid]
+        dists[block[valid]] = nearest_dists[valid]
+    return indices, dists
+
+def knn_graph(x, num_neighbors=16, num_trees=8, leaf_size=64, seed=0):
+    # approximate kNN from a forest of random-projection trees: candidates are the union of each
+    # point's leaves, duplicates are dropped and the k closest kept. O(T N (log N + leaf_size) D).
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        candidates, candidate_dists = [], []
+        for _ in range(num_trees):
+            indices, dists = leaf_neighbors(x, rp_tree_leaves(x, leaf_size, generator), num_neighbors)
+            candidates.append(indices)
+            candidate_dists.append(dists)
+        candidates = torch.cat(candidates, dim=1)
+        candidate_dists = torch.cat(candidate_dists, dim=1)
+        candidates, order = torch.sort(candidates, dim=1)
+        candidate_dists = torch.gather(candidate_dists, 1, order)
+        duplicate = torch.zeros_like(candidates, dtype=torch.bool)
+        duplicate[:, 1:] = candidates[:, 1:] == candidates[:, :-1]
+        candidate_dists.masked_fill_(duplicate, math.inf)
+        k = min(num_neighbors, candidates.shape[1])
+        dists, nearest = torch.topk(candidate_dists, k, dim=1, largest=False)
+        return torch.gather(candidates, 1, nearest), dists
+
+# graphs built in this process, on top of the on-disk cache
+knn_graphs = {}
+
+def cached_knn_graph(x, cache_dir=None, **kwargs):
+    key = fingerprint(x) + str(sorted(kwargs.items()))
+    if key in knn_graphs:
+        return knn_graphs[key]
+    path = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, f'knn_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pt')
+    if path is not None and os.path.exists(path):
+        saved = torch.load(path, map_location=x.device)
+        graph = (saved['indices'], saved['sq_dists'])
+    else:
+        graph = knn_graph(x, **kwargs)
+        if path is not None:
+            torch.save({'indices': graph[0].cpu(), 'sq_dists': graph[1].cpu()}, path)
+    knn_graphs[key] = graph
+    return graph
+
+class KNNPseudoLabeller:
+    # harmonic label propagation over the approximate kNN graph, with the labelled points clamped.
+    # Edge weights are exp(-d^2/(2 l^2)) under each function's lengthscale; a small prior_weight
+    # pulls points far from any label back to mean_prior like the GP does. The outputscale only
+    # scales a GP mean through the signal-to-noise ratio and is not used here.
+    def __init__(self, mean_prior=0.0, num_neighbors=16, num_trees=8, leaf_size=64, num_iters=50,
+                 prior_weight=1e-3, cache_dir=None, seed=0):
+        self.mean_prior = mean_prior
+        self.graph_options = {'num_neighbors': num_neighbors, 'num_trees': num_trees, 'leaf_size': leaf_size, 'seed': seed}
+        self.num_iters = num_iters
+        self.prior_weight = prior_weight
+        self.cache_dir = cache_dir
+
+    def __call__(self, x_train, y_train, num_samples, lengthscales, variances):
+        neighbors, dists = cached_knn_graph(x_train, cache_dir=self.cache_dir, **self.graph_options)
+        with torch.no_grad():
+            lengthscales = torch.cat([torch.as_tensor(l, device=x_train.device).detach().reshape(-1) for l in lengthscales])
+            # (N, k, F) edge weights, one bandwidth per function
+            weights = torch.exp(-0.5*dists.unsqueeze(-1)/lengthscales.pow(2))
+            normalizer = weights.sum(1) + self.prior_weight
+            num_labelled = num_samples + 1
+            f = torch.full((x_train.shape[0], lengthscales.shape[0]), float(self.mean_prior), dtype=x_train.dtype, device=x_train.device)
+            f[:num_labelled] = y_train[:num_labelled].unsqueeze(-1)
+            for _ in range(self.num_iters):
+                propagated = ((weights*f[neighbors]).sum(1) + self.prior_weight*self.mean_prior)/normalizer
+                f[num_labelled:] = propagated[num_labelled:]
+        return list(f[num_labelled:].T)
+
+def build_pseudo_labeller(engine, base_GP_Model, batched=False, **options):
+    if engine == 'gp':
+        return GPPseudoLabeller(base_GP_Model, batched=batched)
+    if engine == 'knn':
+        return KNNPseudoLabeller(mean_prior=float(base_GP_Model.mean_prior), **options)
+    raise NotImplementedError(f'Pseudo-labeller {engine} not understood.')
@@ -0,0 +1,342 @@
+import os
+import sys
+import stat
+import time
+import fcntl
+import hashlib
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import torch
+from gaussian_process.GP import GP
+from gaussian_process.cache import FactorBank
+from gaussian_process.kernels import native_kernel_dict, kernel_mean_and_grad
+
+# A local GP service shared by concurrently running sweep jobs. Each dataset is sent once and kept
+# in the service's memory; distance caches and factorizations live once in its FactorBank, keyed
+# by dataset digest and hyperparameters. Runners talk to it over a UNIX socket through GPClient,
+# which mirrors the GP interface used by sampling_data_from_GP. Messages are pickled, so the
+# socket is owner-only and connections need a random per-user key stored next to it. Jobs on
+# different models run concurrently: only requests to the same model are serialized.
+
+DEFAULT_ADDRESS = '/tmp/gp_service.sock'
+
+def load_authkey(address=DEFAULT_ADDRESS):
+    # <address>.key, created 0600 with 32 random bytes by whichever side comes first
+    path = address + '.key'
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+    except FileExistsError:
+        pass
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+        raise PermissionError(f'{path} must be owned by the current user and not accessible to others')
+    with open(path, 'rb') as f:
+        key = f.read()
+    if len(key) < 32:
+        # another process is still writing it
+        time.sleep(0.1)
+        with open(path, 'rb') as f:
+            key = f.read()
+    return key
+
+def dataset_digest(x, y):
+    # y may be None for inputs-only datasets (the full-data refit solves its own label vectors)
+    h = hashlib.sha1()
+    for t in (x, y):
+        a = np.zeros(0, dtype=np.float32) if t is None else t.detach().cpu().contiguous().numpy()
+        h.update(str((a.shape, a.dtype.str)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+class LockedBank(FactorBank):
+    # FactorBank shared by the service's connection threads
+    def __init__(self, max_bytes):
+        super().__init__(max_bytes)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return super().get(key)
+
+    def put(self, key, value):
+        with self.lock:
+            super().put(key, value)
+
+    def stats(self):
+        with self.lock:
+            return super().stats()
+
+class GPService:
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, max_memory_mb=4096, max_datasets=16, device='cpu'):
+        self.address = address
+        self.authkey = load_authkey(address) if authkey is None else authkey
+        self.device = device
+        self.bank = LockedBank(max_bytes=int(max_memory_mb*1024**2))
+        self.max_datasets = max_datasets
+        self.datasets = OrderedDict()  # digest -> (x, y) tensors
+        self.models = {}  # (digest, kernel, options) -> (GP, lock)
+        # guards the two registries only; a model's own lock is held while it solves or predicts
+        self.lock = threading.Lock()
+
+    def register(self, digest, x, y):
+        with self.lock:
+            if digest in self.datasets:
+                return
+            y = np.zeros(0, dtype=x.dtype) if y is None else y
+            self.datasets[digest] = (torch.from_numpy(x).to(self.device), torch.from_numpy(y).to(self.device))
+            while len(self.datasets) > self.max_datasets:
+                # models still serving a request keep their tensors alive until it is done
+                old, _ = self.datasets.popitem(last=False)
+                for key in [key for key in self.models if key[0] == old]:
+                    del self.models[key]
+
+    def model(self, digest, kernel, options, hypers):
+        key = (digest, kernel, tuple(sorted(options.items())))
+        with self.lock:
+            if digest not in self.datasets:
+                raise KeyError(f'dataset {digest} is not registered')
+            if key not in self.models:
+                x, y = self.datasets[digest]
+                # built with the first request's hyperparameters; configure sets them per request
+                self.models[key] = (GP(self.device, x, y, *[torch.tensor(h, device=self.device) for h in hypers],
+                                       kernel=kernel, bank=self.bank, cache_key=key, **options),
+                                    threading.Lock())
+            self.datasets.move_to_end(digest)
+            gp, lock = self.models[key]
+        return gp, key, lock
+
+    def configure(self, gp, hypers):
+        lengthscale, variance, noise, mean_prior = [torch.tensor(h, device=self.device) for h in hypers]
+        gp.noise, gp.mean_prior = noise, mean_prior
+        gp.kernel.lengthscale = lengthscale
+        gp.variance = variance
+        return gp
+
+    def coefficients(self, gp, key):
+        # coefficients are cached next to the factor they were solved with
+        coef_key = (key, 'coef') + gp.hyper_key() + (float(gp.mean_prior),)
+        entry = self.bank.get(coef_key)
+        if entry is None:
+            entry = {'coef': gp.solve(gp.y_train)}
+            self.bank.put(coef_key, entry)
+        gp.coef = entry['coef']
+        return gp
+
+    def points(self, gp, x):
+        # ('rows', start, stop) references rows of the registered dataset instead of shipping them
+        if isinstance(x, tuple) and x[0] == 'rows':
+            return gp.x_train[x[1]:x[2]]
+        return torch.from_numpy(x).to(self.device)
+
+    def dispatch(self, message):
+        op = message[0]
+        if op == 'ping':
+            return 'pong'
+        if op == 'lookup':
+            with self.lock:
+                return message[1] in self.datasets
+        if op == 'register':
+            _, digest, x, y = message
+            self.register(digest, x, y)
+            return True
+        if op == 'stats':
+            with self.lock:
+                counts = {'datasets': len(self.datasets), 'models': len(self.models)}
+            return dict(counts, bank=self.bank.stats())
+        if op == 'solve':
+            # (K + noise*I)^{-1} (b - mean_prior) against the shared factor
+            _, digest, kernel, options, hypers, b = message
+            gp, _, lock = self.model(digest, kernel, options, hypers)
+            with lock:
+                self.configure(gp, hypers)
+                return gp.solve(torch.from_numpy(b).to(self.device)).cpu().numpy()
+        if op in ('mean_posterior', 'mean_and_grad', 'variance_posterior'):
+            _, digest, kernel, options, hypers, x = message
+            gp, key, lock = self.model(digest, kernel, options, hypers)
+            with lock:
+                self.configure(gp, hypers)
+                if op != 'variance_posterior':
+                    self.coefficients(gp, key)
+                x = self.points(gp, x)
+                if op == 'mean_posterior':
+                    return gp.mean_posterior(x).detach().cpu().numpy()
+                if op == 'variance_posterior':
+                    return gp.variance_posterior(x).cpu().numpy()
+                mu, grad = gp.mean_and_grad(x)
+                return mu.detach().cpu().numpy(), grad.detach().cpu().numpy()
+        raise NotImplementedError(f'Operation {op} not understood.')
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    result = ('ok', self.dispatch(message))
+                except Exception as e:
+                    result = ('error', repr(e))
+                conn.send(result)
+
+    def serve_forever(self):
+        # one service per address: the lock file makes racing autostarts exit quietly
+        lock_file = open(self.address + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        # the socket is created owner-only rather than chmod-ed after binding
+        umask = os.umask(0o077)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(umask)
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+def start_service(address=DEFAULT_ADDRESS, max_memory_mb=4096, device='cpu'):
+    return subprocess.Popen([sys.executable, '-m', 'gaussian_process.service', '--address', address,
+                             '--max_memory_mb', str(max_memory_mb), '--device', str(device)],
+                            start_new_session=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def connect(address=DEFAULT_ADDRESS, authkey=None, autostart=False, max_memory_mb=4096,
+            device='cpu', timeout=60):
+    authkey = load_authkey(address) if authkey is None else authkey
+    try:
+        return Client(address, family='AF_UNIX', authkey=authkey)
+    except (FileNotFoundError, ConnectionRefusedError):
+        if not autostart:
+            raise
+    start_service(address, max_memory_mb=max_memory_mb, device=device)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return Client(address, family='AF_UNIX', authkey=authkey)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+class GPClient:
+    # GP-compatible proxy: hyperparameters and data stay local, solves and posterior queries go to
+    # the service. With y_train=None only the inputs are registered, so jobs whose label vectors
+    # differ (the pseudo-labelled refit) share one factor; once coef is set, as sampling_data_from_GP
+    # does with the solved label vectors, posterior means are evaluated locally from it.
+    def __init__(self, device, x_train, y_train, lengthscale, variance, noise, mean_prior, kernel='rbf',
+                 address=DEFAULT_ADDRESS, authkey=None, autostart=False, max_memory_mb=4096,
+                 service_device='cpu', **options):
+        self.device = device
+        self.x_train = x_train
+        self.y_train = y_train
+        self.kernel_name = kernel
+        self.kernel_impl = 'native'
+        self.kernel = native_kernel_dict[kernel]().to(device)
+        self.kernel.lengthscale = lengthscale
+        self.variance = variance
+        self.noise = noise
+        self.mean_prior = mean_prior
+        self.options = options
+        self.coef = None
+        self.conn = connect(address, authkey, autostart=autostart, max_memory_mb=max_memory_mb, device=service_device)
+        self.register()
+
+    def request(self, *message):
+        self.conn.send(message)
+        status, result = self.conn.recv()
+        if status == 'error':
+            raise RuntimeError(f'GP service: {result}')
+        return result
+
+    def register(self):
+        self.digest = dataset_digest(self.x_train, self.y_train)
+        if not self.request('lookup', self.digest):
+            y = None if self.y_train is None else self.y_train.detach().cpu().numpy()
+            self.request('register', self.digest, self.x_train.detach().cpu().numpy(), y)
+
+    def hypers(self):
+        return tuple(float(torch.as_tensor(h).reshape(-1)[0]) for h in
+                     (self.kernel.lengthscale, self.variance, self.noise, self.mean_prior))
+
+    def hyper_key(self):
+        lengthscale, variance, noise, _ = self.hypers()
+        return ((lengthscale,), (variance,), (noise,))
+
+    def encode(self, x):
+        # row slices of x_train are sent as a reference, everything else by value
+        x_train = self.x_train
+        if (x.device == x_train.device and x.dim() == 2 and x.stride() == x_train.stride()
+                and x.untyped_storage().data_ptr() == x_train.untyped_storage().data_ptr()):
+            start = (x.storage_offset() - x_train.storage_offset())//x_train.stride(0)
+            if 0 <= start and start + x.shape[0] <= x_train.shape[0]:
+                return ('rows', start, start + x.shape[0])
+        return x.detach().cpu().numpy()
+
+    def query(self, op, x):
+        return self.request(op, self.digest, self.kernel_name, self.options, self.hypers(), self.encode(x))
+
+    def set_hyper(self, lengthscale, variance):
+        self.kernel.lengthscale = lengthscale
+        self.variance = variance
+        self.coef = None
+
+    def set_labels(self, y_train):
+        self.y_train = y_train
+        self.coef = None
+        self.register()
+
+    def add_points(self, x_new, y_new, cache_key=None):
+        self.x_train = torch.cat([self.x_train, x_new])
+        self.y_train = torch.cat([self.y_train, y_new])
+        self.coef = None
+        self.register()
+
+    def basis(self):
+        return self.x_train
+
+    def solve(self, y):
+        b = y.detach().cpu().numpy()
+        return torch.from_numpy(self.request('solve', self.digest, self.kernel_name, self.options, self.hypers(), b)).to(y.device)
+
+    def mean_posterior(self, x_test):
+        if self.coef is not None:
+            return self.mean_and_grad(x_test)[0]
+        return torch.from_numpy(self.query('mean_posterior', x_test)).to(x_test.device)
+
+    def variance_posterior(self, x_test):
+        return torch.from_numpy(self.query('variance_posterior', x_test)).to(x_test.device)
+
+    def mean_and_grad(self, x_test):
+        if self.coef is not None:
+            mu, grad = kernel_mean_and_grad(self.kernel, self.basis(), self.coef, x_test, self.variance)
+            return self.mean_prior + mu, grad
+        mu, grad = self.query('mean_and_grad', x_test)
+        return torch.from_numpy(mu).to(x_test.device), torch.from_numpy(grad).to(x_test.device)
+
+    def stats(self):
+        return self.request('stats')
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--address', type=str, default=DEFAULT_ADDRESS)
+    parser.add_argument('--max_memory_mb', type=float, default=4096)
+    parser.add_argument('--max_datasets', type=int, default=16)
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+    GPService(args.address, max_memory_mb=args.max_memory_mb, max_datasets=args.max_datasets,
+              device=args.device).serve_forever()
@@ -0,0 +1,103 @@
+import torch
+
+def tiled_matvec(kernel_rows, x, v, noise, tile_size=1024):
+    # (K + noise*I) @ v without materializing K: kernel_rows(x_tile, out) fills a (tile, N) buffer
+    squeeze = v.dim() == 1
+    if squeeze:
+        v = v.unsqueeze(-1)
+    N = x.shape[0]
+    out = torch.empty_like(v)
+    buffer = torch.empty(min(tile_size, N), N, dtype=x.dtype, device=x.device)
+    for start in range(0, N, tile_size):
+        end = min(start + tile_size, N)
+        K_tile = kernel_rows(x[start:end], out=buffer[:end-start])
+        torch.matmul(K_tile, v, out=out[start:end])
+    out.add_(v*noise)
+    return out.squeeze(-1) if squeeze else out
+
+def cholesky_(A, block_size=1024):
+    # lower Cholesky factor of A written over A, by right-looking blocks: only a diagonal block and
+    # one panel block are allocated at a time, so factorizing needs no second N x N matrix
+    N = A.shape[-1]
+    for start in range(0, N, block_size):
+        end = min(start + block_size, N)
+        L_kk = A[start:end, start:end]
+        L_kk.copy_(torch.linalg.cholesky(L_kk))
+        for rows in range(end, N, block_size):
+            panel = A[rows:rows+block_size, start:end]
+            panel.copy_(torch.linalg.solve_triangular(L_kk.T, panel, upper=True, left=False))
+        for rows in range(end, N, block_size):
+            # lower part of the trailing block row: A_i,end:i+b -= L_ik L_(end:i+b)k^T
+            stop = min(rows + block_size, N)
+            A[rows:stop, end:stop].addmm_(A[rows:stop, start:end], A[end:stop, start:end].T, alpha=-1)
+    # the upper triangle still holds the input
+    return A.tril_()
+
+def pivoted_cholesky(kernel_rows, x, diag, rank, tol=1e-6, return_pivots=False):
+    # greedy rank-k factor L (N, k) with K ~= L L^T, computing one kernel row per pivot
+    N = x.shape[0]
+    diag = diag.clone()
+    L = torch.zeros(rank, N, dtype=x.dtype, device=x.device)
+    pivots = []
+    for m in range(rank):
+        i = int(torch.argmax(diag))
+        pivot = diag[i]
+        if pivot < tol:
+            L = L[:m]
+            break
+        pivots.append(i)
+        row = kernel_rows(x[i:i+1]).squeeze(0)
+        if m > 0:
+            row = row - torch.matmul(L[:m, i], L[:m])
+        L[m] = row/torch.sqrt(pivot)
+        diag.sub_(L[m].pow(2)).clamp_min_(0)
+    if return_pivots:
+        return L.T, pivots
+    return L.T
+
+class WoodburyPreconditioner:
+    # P = L L^T + noise*I, applied through the Woodbury identity in O(Nk)
+    def __init__(self, L, noise):
+        self.L = L
+        self.noise = noise
+        if L.shape[1] > 0:
+            inner = torch.matmul(L.T, L)
+            inner.diagonal().add_(noise)
+            self.inner_chol = torch.linalg.cholesky(inner)
+
+    def __call__(self, r):
+        if self.L.shape[1] == 0:
+            return r/self.noise
+        t = torch.cholesky_solve(torch.matmul(self.L.T, r), self.inner_chol)
+        return (r - torch.matmul(self.L, t))/self.noise
+
+def pcg(matvec, b, precond=None, tol=1e-4, max_iter=1000):
+    # preconditioned conjugate gradients for SPD systems; b may hold several right-hand sides
+    squeeze = b.dim() == 1
+    if squeeze:
+        b = b.unsqueeze(-1)
+    if precond is None:
+        precond = lambda r: r
+    x = torch.zeros_like(b)
+    r = b.clone()
+    z = precond(r)
+    p = z.clone()
+    rz = (r*z).sum(0)
+    b_norm = b.norm(dim=0).clamp_min(1e-30)
+    num_iter = 0
+    for num_iter in range(1, max_iter + 1):
+        Ap = matvec(p)
+        pAp = (p*Ap).sum(0)
+        converged = r.norm(dim=0)/b_norm < tol
+        alpha = torch.where(converged, torch.zeros_like(rz), rz/pAp.clamp_min(1e-30))
+        x.add_(alpha*p)
+        r.sub_(alpha*Ap)
+        converged = r.norm(dim=0)/b_norm < tol
+        if converged.all():
+            break
+        z = precond(r)
+        rz_new = (r*z).sum(0)
+        beta = torch.where(converged, torch.zeros_like(rz), rz_new/rz.clamp_min(1e-30))
+        p.mul_(beta).add_(z)
+        rz = rz_new
+    return (x.squeeze(-1) if squeeze else x), num_iter
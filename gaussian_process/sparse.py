@@ -0,0 +1,114 @@
+import torch
+from gaussian_process.GP import GP
+from gaussian_process.kernels import sq_dist
+from gaussian_process.solvers import pivoted_cholesky
+
+def kmeans_plus_plus(x, num_points, num_iters=10, generator=None):
+    # k-means++ seeding followed by a few Lloyd iterations; a local generator keeps the
+    # global RNG stream of the sampler untouched
+    N = x.shape[0]
+    first = int(torch.randint(N, (1,), generator=generator))
+    selected = [first]
+    min_dist = sq_dist(x, x[first:first+1]).squeeze(-1)
+    for _ in range(1, num_points):
+        total = min_dist.sum()
+        if total <= 0:
+            break
+        idx = int(torch.multinomial((min_dist/total).cpu(), 1, generator=generator))
+        selected.append(idx)
+        min_dist = torch.minimum(min_dist, sq_dist(x, x[idx:idx+1]).squeeze(-1))
+    centers = x[selected].clone()
+    for _ in range(num_iters):
+        assign = sq_dist(x, centers).argmin(dim=1)
+        sums = torch.zeros_like(centers).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=centers.shape[0])
+        nonempty = counts > 0
+        centers[nonempty] = sums[nonempty]/counts[nonempty].unsqueeze(-1).to(x.dtype)
+    return centers
+
+def select_inducing_points(gp, num_inducing, method='kmeans', seed=0):
+    x = gp.x_train
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        if method == 'kmeans':
+            return kmeans_plus_plus(x, num_inducing, generator=generator)
+        if method == 'variance':
+            # greedy maximum posterior variance, i.e. the pivots of a pivoted Cholesky
+            diag = torch.as_tensor(gp.variance, device=x.device).reshape(-1)[0].expand(x.shape[0])
+            _, pivots = pivoted_cholesky(gp.kernel_rows, x, diag, num_inducing, return_pivots=True)
+            return x[pivots].clone()
+        if method == 'random':
+            return x[torch.randperm(x.shape[0], generator=generator)[:num_inducing].to(x.device)].clone()
+    raise NotImplementedError(f'Inducing point method {method} not understood.')
+
+class SparseGP(GP):
+    # SGPR (Titsias) posterior mean on M inducing points: O(NM) memory, O(NM^2) time.
+    # The coef vector lives on the inducing points, so mean_posterior is inherited unchanged.
+    def __init__(self, device, x_train, y_train, lengthscale, variance, noise, mean_prior, num_inducing=512,
+                 inducing_method='kmeans', inducing_x=None, inducing_jitter=1e-4, seed=0, **kwargs):
+        super().__init__(device, x_train, y_train, lengthscale, variance, noise, mean_prior, **kwargs)
+        self.num_inducing = min(num_inducing, x_train.shape[0])
+        self.inducing_jitter = inducing_jitter
+        if inducing_x is None:
+            inducing_x = select_inducing_points(self, self.num_inducing, method=inducing_method, seed=seed)
+        self.inducing_x = inducing_x
+        self.factor = None
+
+    def basis(self):
+        return self.inducing_x
+
+    def factorize(self):
+        key = self.hyper_key()
+        if self.factor is not None and self.factor_key == key:
+            return self.factor
+        with torch.no_grad():
+            K_zz = self.covariance(self.inducing_x, self.inducing_x)
+            K_zz.diagonal().add_(self.inducing_jitter*torch.as_tensor(self.variance).reshape(-1)[0])
+            L = torch.linalg.cholesky(K_zz)
+            sigma = torch.sqrt(torch.as_tensor(self.noise))
+            # A = L^{-1} K_zx / sigma, B = I + A A^T
+            A = torch.linalg.solve_triangular(L, self.covariance(self.inducing_x, self.x_train), upper=False).div_(sigma)
+            B = torch.matmul(A, A.T)
+            B.diagonal().add_(1)
+            LB = torch.linalg.cholesky(B)
+        self.factor = (L, LB, A, sigma)
+        self.factor_key = key
+        return self.factor
+
+    def solve(self, y):
+        # coef on the inducing points: L^{-T} B^{-1} A (y - m) / sigma
+        with torch.no_grad():
+            L, LB, A, sigma = self.factorize()
+            b = y - self.mean_prior
+            squeeze = b.dim() == 1
+            if squeeze:
+                b = b.unsqueeze(-1)
+            c = torch.cholesky_solve(torch.matmul(A, b).div_(sigma), LB)
+            coef = torch.linalg.solve_triangular(L.T, c, upper=True)
+        return (coef.squeeze(-1) if squeeze else coef).detach()
+
+    def add_points(self, x_new, y_new, cache_key=None):
+        # the inducing points stay fixed; the O(NM^2) factor is simply rebuilt for the grown data
+        self.factor = None
+        super().add_points(x_new, y_new, cache_key=cache_key)
+
+    def variance_posterior(self, x_test, out=None):
+        # SGPR predictive variance: variance - ||L^{-1} K_zx||^2 + ||LB^{-1} L^{-1} K_zx||^2
+        with torch.no_grad():
+            L, LB, A, sigma = self.factorize()
+            M = x_test.shape[0]
+            tile_size = self.test_tile_size(M) or M
+            if out is None:
+                out = torch.empty(M, dtype=self.x_train.dtype, device=self.x_train.device)
+            buffer = self.scratch(tile_size)
+            for start in range(0, M, tile_size):
+                end = min(start + tile_size, M)
+                K_tile = self.covariance(x_test[start:end], self.inducing_x, out=buffer[:end-start])
+                V = torch.linalg.solve_triangular(L, K_tile.T, upper=False)
+                W = torch.linalg.solve_triangular(LB, V, upper=False)
+                out[start:end] = self.variance - V.pow(2).sum(0) + W.pow(2).sum(0)
+            out.clamp_min_(0)
+        return out
+
+    def log_marginal_likelihood(self, y=None):
+        raise NotImplementedError('log marginal likelihood is not implemented for SparseGP')
@@ -14,12 +14,16 @@ from abc import ABC, abstractmethod
 from tqdm.autonotebook import tqdm
 
 from runners.base.EMA import EMA
-from runners.utils import make_save_dirs, remove_file, sampling_data_from_GP, create_train_dataloader, create_val_dataloader, sampling_from_offline_data, testing_by_oracle
+from runners.utils import make_save_dirs, remove_file, build_base_GP, build_hyper_bank, generate_GP_pairs, fit_GP_hyperparameters, create_train_dataloader, create_val_dataloader, sampling_from_offline_data, testing_by_oracle, PairBank
 import numpy as np
 
 import gpytorch 
 from gaussian_process.GPlib import ExactGPModel
 from gaussian_process.GP import GP
+from runners.pipeline import PairProducer
+from runners.pair_store import PairStore, data_digest, pair_key
+from runners.replay import ReplayBuffer
+from gaussian_process.projection import build_projection
 import design_bench
 
 class BaseRunner(ABC):
@@ -91,6 +95,10 @@ class BaseRunner(ABC):
     
         self.offline_x = self.offline_x.to(self.config.training.device[0])
         self.offline_y = self.offline_y.to(self.config.training.device[0])
+        # optional projection the GP works in (GP.projection), fitted at the start of train
+        self.projection = None
+        self.pair_store = None
+        self.replay = None
 
     def get_offline_data(self):
         if self.config.task.name != 'TFBind10-Exact-v0':
@@ -122,6 +130,100 @@ class BaseRunner(ABC):
         
         return torch.from_numpy(offline_x), torch.from_numpy(mean_x), torch.from_numpy(std_x), torch.from_numpy(offline_y), torch.from_numpy(mean_y), torch.from_numpy(std_y)
 
+    def pair_key(self, epoch, digest=None):
+        if digest is None:
+            digest = data_digest(self.offline_x, self.offline_y, self.num_samples)
+        return pair_key(self.config, digest, self.num_samples, epoch)
+
+    def start_producer(self, start_epoch):
+        pipeline = self.config.GP.pipeline
+        # epochs already in the pair store are loaded instead
+        epochs = list(range(start_epoch, self.config.training.n_epochs))
+        if self.replay is not None:
+            # only the regular GP calls; early ones triggered by the buffer are made inline
+            epochs = [epoch for epoch in epochs if self.replay.scheduled(epoch)]
+        if self.pair_store is not None:
+            digest = data_digest(self.offline_x, self.offline_y, self.num_samples)
+            epochs = [epoch for epoch in epochs if not self.pair_store.contains(self.pair_key(epoch, digest))]
+        return PairProducer(depth=pipeline.depth if pipeline.__contains__('depth') else 1,
+                            config=self.config,
+                            x_train=self.offline_x,
+                            y_train=self.offline_y.clone(),
+                            num_samples=self.num_samples,
+                            epochs=epochs,
+                            projection=self.projection)
+
+    def epoch_pairs(self, epoch, GP_Model, hyper_bank=None, producer=None):
+        # the epoch's pair bank from the pair store, the background producer or an inline GP call
+        # epochs the producer was started on are always taken from its queue, even if another run
+        # stored them since, so the queue stays in step with the epochs
+        produced = producer is not None and epoch in producer.epochs
+        if self.pair_store is not None:
+            key = self.pair_key(epoch)
+            if not produced:
+                data_from_GP = self.pair_store.load(key, device=self.config.training.device[0])
+                if data_from_GP is not None:
+                    self.logger(f"epoch {epoch}: {len(data_from_GP)} pairs loaded from the pair store")
+                    return data_from_GP
+        if produced:
+            data_from_GP = producer.get(epoch)
+        else:
+            data_from_GP = generate_GP_pairs(self.config, self.offline_x, self.offline_y, self.num_samples,
+                                             GP_Model, epoch, hyper_bank=hyper_bank, projection=self.projection)
+        if self.pair_store is not None:
+            self.pair_store.save(key, data_from_GP, epoch=epoch)
+        return data_from_GP
+
+    def gp_inputs(self, x):
+        return x if self.projection is None else self.projection.project(x)
+
+    def query_oracle(self, GP_Model, query_size, beta=2.0):
+        # one active-learning round: label the top UCB designs of the unlabelled pool with the
+        # oracle and grow the base GP with a block Cholesky update instead of a refit
+        if not hasattr(self, 'oracle_task'):
+            if self.config.task.name != 'TFBind10-Exact-v0':
+                self.oracle_task = design_bench.make(self.config.task.name)
+            else:
+                self.oracle_task = design_bench.make(self.config.task.name,
+                                                     dataset_kwargs={"max_samples": 10000})
+            if self.oracle_task.is_discrete:
+                self.oracle_task.map_to_logits()
+        task = self.oracle_task
+        # sampling_data_from_GP only restores the base lengthscale/variance, and with the pipeline,
+        # the pair store or the batched/kNN paths it never refits this GP at all, so the posterior
+        # coefficients are solved here under the base hyperparameters
+        GP_Model.set_hyper(lengthscale=GP_Model.kernel.lengthscale, variance=GP_Model.variance)
+        ns = self.num_samples
+        pool = self.gp_inputs(self.offline_x[ns+1:])
+        with torch.no_grad():
+            ucb = GP_Model.mean_posterior(pool) + beta*GP_Model.variance_posterior(pool).sqrt()
+        chosen = torch.topk(ucb, min(query_size, pool.shape[0])).indices + ns + 1
+        k = chosen.shape[0]
+
+        x_query = self.offline_x[chosen].cpu()
+        if self.config.task.normalize_x:
+            x_query = x_query * self.std_offline_x + self.mean_offline_x
+        if task.is_discrete:
+            x_query = x_query.reshape(x_query.shape[0], task.x.shape[1], task.x.shape[2])
+        y_query = torch.from_numpy(task.predict(x_query.numpy())).reshape(-1)
+        if self.config.task.normalize_y:
+            y_query = (y_query - self.mean_offline_y) / self.std_offline_y
+        y_query = y_query.to(self.offline_y)
+
+        # keep the layout labelled prefix | spare labelled point | unlabelled pool:
+        # [0:ns] + chosen + [ns] + the rest
+        rest = torch.ones(self.offline_x.shape[0], dtype=torch.bool, device=chosen.device)
+        rest[:ns+1] = False
+        rest[chosen] = False
+        order = torch.cat([torch.arange(ns, device=chosen.device), chosen,
+                           torch.tensor([ns], device=chosen.device), torch.nonzero(rest).squeeze(-1)])
+        self.offline_x = self.offline_x[order]
+        self.offline_y = self.offline_y[order]
+        self.offline_y[ns:ns+k] = y_query
+        GP_Model.add_points(self.gp_inputs(self.offline_x[ns:ns+k]), self.offline_y[ns:ns+k], cache_key=('base', ns+k))
+        self.num_samples = ns + k
+        return y_query
+
     # print msg
     def logger(self, msg, **kwargs):
         print(msg, **kwargs)
@@ -347,12 +449,32 @@ class BaseRunner(ABC):
         start_epoch = self.global_epoch
         # self.logger(f"start training {self.config.model.model_name} on {self.config.task.name}")
 
+        producer = None
         try:
-            # initialize params for GP
-            lengthscale = torch.tensor(self.config.GP.initial_lengthscale, device=self.config.training.device[0])
-            variance = torch.tensor(self.config.GP.initial_outputscale, device=self.config.training.device[0])
-            noise = torch.tensor(self.config.GP.noise, device=self.config.training.device[0])
-            mean_prior = torch.tensor(0.0, device = self.config.training.device[0]) 
+            # run the GP kernel and the design ascent in a k-dim PCA/random subspace of offline_x
+            if self.config.GP.__contains__('projection'):
+                projection = self.config.GP.projection
+                self.projection = build_projection(self.offline_x,
+                                                   method=projection.method if projection.__contains__('method') else 'pca',
+                                                   dim=projection.dim,
+                                                   seed=self.config.args.seed)
+                message = f"GP projection: {self.offline_x.shape[1]} -> {self.projection.dim} dims"
+                if hasattr(self.projection, 'explained_variance_ratio'):
+                    message += f" ({100*self.projection.explained_variance_ratio:.1f}% variance)"
+                self.logger(message)
+            # replace the hand-tuned GP hyperparameters by a marginal-likelihood fit on the labelled subset
+            if self.config.GP.__contains__('fit_hyper'):
+                fitted = fit_GP_hyperparameters(self.config,
+                                                self.gp_inputs(self.offline_x[:self.num_samples]),
+                                                self.offline_y[:self.num_samples])
+                self.config.GP.initial_lengthscale = fitted['lengthscale']
+                self.config.GP.initial_outputscale = fitted['outputscale']
+                self.config.GP.noise = fitted['noise']
+                self.logger(f"GP fit: lengthscale {fitted['lengthscale']:.4f} outputscale {fitted['outputscale']:.4f} "
+                            f"noise {fitted['noise']:.2e} lml {fitted['lml']:.2f} (restart {fitted['restart']})")
+                self.save_config()
+            # optional bank of kernel factorizations reused across epochs
+            hyper_bank = build_hyper_bank(self.config)
             
             #GP_Model.set_hyper(lengthscale=lengthscale,variance=variance)
             
@@ -366,38 +488,59 @@ class BaseRunner(ABC):
             #     self.best_x = self.offline_x 
             
             val_loader = None
-            val_dataset = []
+            val_dataset = PairBank()
             
             accumulate_grad_batches = self.config.training.accumulate_grad_batches 
+            # built once so its pairwise-distance cache survives across epochs;
+            # sampling_data_from_GP restores its base hyperparameters on return
+            GP_Model = build_base_GP(self.config,
+                                     self.gp_inputs(self.offline_x[:self.num_samples]),
+                                     self.offline_y[:self.num_samples],
+                                     num_test=self.offline_x.shape[0] - self.num_samples - 1,
+                                     hyper_bank=hyper_bank)
+            # with GP.store the pair banks are read from / written to a store shared across runs
+            self.pair_store = None
+            if self.config.GP.__contains__('store'):
+                store = self.config.GP.store
+                self.pair_store = PairStore(store.root,
+                                            max_size_mb=store.max_size_mb if store.__contains__('max_size_mb') else 10240,
+                                            verify=store.verify if store.__contains__('verify') else True)
+            # with GP.replay the epochs between GP calls train from a replay buffer
+            num_GP_calls = 0
+            if self.config.GP.__contains__('replay'):
+                replay = self.config.GP.replay
+                self.replay = ReplayBuffer(capacity=replay.capacity,
+                                           interval=replay.interval if replay.__contains__('interval') else 1,
+                                           sampling=replay.sampling if replay.__contains__('sampling') else 'reservoir',
+                                           age_decay=replay.age_decay if replay.__contains__('age_decay') else 0.9,
+                                           min_freshness=replay.min_freshness if replay.__contains__('min_freshness') else 0.0,
+                                           epoch_size=replay.epoch_size if replay.__contains__('epoch_size') else None,
+                                           start_epoch=start_epoch,
+                                           seed=self.config.args.seed)
+            # with GP.pipeline the pairs of the next epochs are generated while this one trains
+            if self.config.GP.__contains__('pipeline'):
+                producer = self.start_producer(start_epoch)
             for epoch in range(start_epoch, self.config.training.n_epochs):
                 ### generate data from GP and create dataloader
                 start_time = time.time()
-                GP_Model = GP(device=self.config.training.device[0],
-                                x_train=self.offline_x[:self.num_samples],
-                                y_train=self.offline_y[:self.num_samples], 
-                                lengthscale=lengthscale, 
-                                variance=variance, 
-                                noise=noise, 
-                                mean_prior=mean_prior)
-                data_from_GP = sampling_data_from_GP(config= self.config,
-                                                    x_train=self.offline_x,
-                                                    y_train=self.offline_y,
-                                                    num_samples = self.num_samples,
-                                                    device=self.config.training.device[0],
-                                                    base_GP_Model= GP_Model, 
-                                                    num_functions=self.config.GP.num_functions,
-                                                    num_gradient_steps=self.config.GP.num_gradient_steps,
-                                                    num_points=self.config.GP.num_points,
-                                                    learning_rate=self.config.GP.sampling_from_GP_lr,
-                                                    delta_lengthscale=self.config.GP.delta_lengthscale,
-                                                    delta_variance=self.config.GP.delta_variance,
-                                                    seed=epoch,
-                                                    threshold_diff=self.config.GP.threshold_diff)
-                train_loader, current_epoch_val_dataset = create_train_dataloader(data_from_GP=data_from_GP,
-                                                        val_frac=self.config.training.val_frac,
-                                                        batch_size=self.config.training.batch_size,
-                                                        shuffle=True)
-                val_dataset = val_dataset + current_epoch_val_dataset
+                if self.replay is None:
+                    data_from_GP = self.epoch_pairs(epoch, GP_Model, hyper_bank, producer)
+                    train_loader, current_epoch_val_dataset = create_train_dataloader(data_from_GP=data_from_GP,
+                                                            val_frac=self.config.training.val_frac,
+                                                            batch_size=self.config.training.batch_size,
+                                                            shuffle=True)
+                    val_dataset = val_dataset + current_epoch_val_dataset
+                else:
+                    # GP calls only when the buffer is due; validation pairs are split off before insertion
+                    if self.replay.due(epoch):
+                        data_from_GP = self.epoch_pairs(epoch, GP_Model, hyper_bank, producer)
+                        train_bank, current_epoch_val_dataset = data_from_GP.split(self.config.training.val_frac)
+                        self.replay.add(train_bank, epoch)
+                        val_dataset = val_dataset + current_epoch_val_dataset
+                        num_GP_calls += 1
+                    train_loader = self.replay.sample(epoch).batches(batch_size=self.config.training.batch_size, shuffle=True)
+                    self.logger(f"epoch {epoch}: replay buffer {len(self.replay)} pairs, freshness {self.replay.freshness():.3f}, "
+                                f"{(epoch - start_epoch + 1)/max(num_GP_calls, 1):.2f} epochs per GP call")
                 
                 pbar = tqdm(train_loader, total=len(train_loader), smoothing=0.01, disable=False)
                 self.global_epoch = epoch
@@ -448,6 +591,25 @@ class BaseRunner(ABC):
                 end_time = time.time()
                 elapsed_rounded = int(round((end_time-start_time)))
                 self.logger("training time: " + str(datetime.timedelta(seconds=elapsed_rounded)))
+                if hyper_bank is not None:
+                    self.logger(f"GP bank: {hyper_bank.stats()}")
+
+                # active few-shot labelling: spend the label budget across rounds between epochs
+                if self.config.__contains__('active') and (epoch + 1) % self.config.active.interval == 0 \
+                        and (epoch + 1) // self.config.active.interval <= self.config.active.rounds:
+                    # the producer works from the old labelled set, so it is restarted after the round
+                    if producer is not None:
+                        producer.close()
+                    y_query = self.query_oracle(GP_Model,
+                                                query_size=self.config.active.query_size,
+                                                beta=self.config.active.beta if self.config.active.__contains__('beta') else 2.0)
+                    self.logger(f"active round {(epoch + 1) // self.config.active.interval}: "
+                                f"labelled {y_query.shape[0]} designs, best {y_query.max().item():.4f}, "
+                                f"num_samples {self.num_samples}")
+                    if self.replay is not None:
+                        self.replay.stale = True
+                    if producer is not None and epoch + 1 < self.config.training.n_epochs:
+                        producer = self.start_producer(epoch + 1)
                 # wandb.log("training time: " + str(datetime.timedelta(seconds=elapsed_rounded)))
 
                 # validation
@@ -539,6 +701,9 @@ class BaseRunner(ABC):
             print('traceback.print_exc():')
             traceback.print_exc()
             print('traceback.format_exc():\n%s' % traceback.format_exc())
+        finally:
+            if producer is not None:
+                producer.close()
 
     @torch.no_grad()
     def test(self, task):
@@ -158,9 +158,9 @@ class BBDMRunner(DiffusionBaseRunner):
         rand_mask = torch.rand(y_high.size())
         mask = (rand_mask <= self.config.training.classifier_free_guidance_prob)
         
-        # mask y_high and y_low
-        y_high[mask] = 0.
-        y_low[mask] = 0.
+        # mask y_high and y_low out of place: batches are views into the pair bank
+        y_high = y_high.masked_fill(mask.to(y_high.device), 0.)
+        y_low = y_low.masked_fill(mask.to(y_low.device), 0.)
             
         x_high = x_high.to(self.config.training.device[0])
         y_high = y_high.to(self.config.training.device[0])
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import torch
+from gaussian_process.cache import fingerprint
+from runners.utils import PairBank
+
+# Content-addressed store of the per-epoch GP pair banks, shared by every run on the host. A bank
+# depends only on the labelled data, the GP config and the epoch, so sweeps over BBDM-only
+# hyperparameters (lr, EMA, classifier_free_guidance_prob) reuse the pairs of the first run.
+#   <root>/manifest.json     key -> {epoch, size, checksums, last_used}
+#   <root>/<key>/<field>.npy one shard per PairBank field, loaded memory-mapped
+
+FIELDS = ('x_high', 'y_high', 'x_low', 'y_low', 'function_id')
+# GP keys that change how the pairs are computed or cached, but not the pairs themselves. GP.bank
+# stays in the key: its grid_size snaps the hyperparameter perturbations.
+IGNORED_GP_KEYS = ('pipeline', 'store', 'service', 'replay')
+
+def plain(config):
+    if isinstance(config, argparse.Namespace):
+        return {key: plain(value) for key, value in vars(config).items()}
+    if isinstance(config, (list, tuple)):
+        return [plain(value) for value in config]
+    return config
+
+def data_digest(x_train, y_train, num_samples):
+    # the designs plus the labels actually used: the unlabelled tail of y_train is pseudo-labelled in place
+    return fingerprint(x_train) + fingerprint(y_train[:num_samples+1])
+
+def pair_key(config, digest, num_samples, epoch):
+    GP_config = {key: value for key, value in plain(config.GP).items() if key not in IGNORED_GP_KEYS}
+    description = {'task': config.task.name, 'data': digest, 'num_samples': num_samples,
+                   'epoch': epoch, 'GP': GP_config}
+    return hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+def file_checksum(path, chunk_size=1 << 24):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class PairStore:
+    def __init__(self, root, max_size_mb=10240, verify=True):
+        self.root = root
+        self.max_bytes = int(max_size_mb*1024**2)
+        self.verify = verify
+        os.makedirs(root, exist_ok=True)
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.lock_path = os.path.join(root, 'manifest.lock')
+
+    def locked(self, update):
+        # read-modify-write of the manifest under an exclusive lock; update returns the result
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = {}
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            result = update(manifest)
+            tmp_path = self.manifest_path + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.manifest_path)
+            return result
+
+    def contains(self, key):
+        return self.locked(lambda manifest: key in manifest)
+
+    def drop(self, manifest, key):
+        manifest.pop(key, None)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def load(self, key, device='cpu'):
+        entry = self.locked(lambda manifest: manifest.get(key))
+        if entry is None:
+            return None
+        if entry['size'] == 0:
+            bank = PairBank()
+        else:
+            directory = os.path.join(self.root, key)
+            fields = []
+            for name in FIELDS:
+                path = os.path.join(directory, name + '.npy')
+                if not os.path.exists(path) or (self.verify and file_checksum(path) != entry['checksums'][name]):
+                    # corrupted or half-evicted shard: forget it and let the caller regenerate
+                    self.locked(lambda manifest: self.drop(manifest, key))
+                    return None
+                # copy-on-write map: pages are read on first touch and writes stay private to this process;
+                # only a move to another device copies the shard
+                fields.append(torch.from_numpy(np.load(path, mmap_mode='c')).to(device))
+            bank = PairBank(*fields)
+
+        def touch(manifest):
+            if key in manifest:
+                manifest[key]['last_used'] = time.time()
+        self.locked(touch)
+        return bank
+
+    def save(self, key, bank, epoch=None):
+        directory = os.path.join(self.root, key)
+        tmp_directory = directory + f'.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        checksums, num_bytes = {}, 0
+        if len(bank) > 0:
+            for name, field in zip(FIELDS, bank.consolidate()):
+                path = os.path.join(tmp_directory, name + '.npy')
+                np.save(path, field.detach().cpu().numpy())
+                checksums[name] = file_checksum(path)
+                num_bytes += os.path.getsize(path)
+
+        def insert(manifest):
+            if key in manifest:
+                # another run stored the same bank first
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+                return
+            shutil.rmtree(directory, ignore_errors=True)
+            os.rename(tmp_directory, directory)
+            manifest[key] = {'epoch': epoch, 'size': len(bank), 'bytes': num_bytes, 'checksums': checksums,
+                             'created': time.time(), 'last_used': time.time()}
+            # least recently used banks go first; the new one is kept even if it alone exceeds the budget
+            total = sum(entry['bytes'] for entry in manifest.values())
+            for old in sorted(manifest, key=lambda k: manifest[k]['last_used']):
+                if total <= self.max_bytes:
+                    break
+                if old != key:
+                    total -= manifest[old]['bytes']
+                    self.drop(manifest, old)
+        self.locked(insert)
+
+    def stats(self):
+        return self.locked(lambda manifest: {'entries': len(manifest),
+                                             'bytes': sum(entry['bytes'] for entry in manifest.values())})
@@ -0,0 +1,90 @@
+import queue
+import traceback
+import torch.multiprocessing as mp
+from runners.utils import build_base_GP, build_hyper_bank, generate_GP_pairs
+
+# Background generation of the GP training pairs: the pair bank of epoch e+1 is built while the
+# diffusion model trains on epoch e, in a spawned worker process with its own base GP and factor
+# bank. Every epoch is sampled with seed=epoch on the worker's own global RNG, so the pairs are
+# the same as inline generation. There is no thread mode: sampling_data_from_GP seeds the global
+# RNG, which BBDMRunner.loss_fn reseeds every step from the training thread.
+
+def produce_pairs(pairs_queue, stop, config, x_train, y_train, num_samples, epochs, projection=None):
+    def put(item):
+        # blocks while the queue is full, gives up once the consumer has stopped
+        while not stop.is_set():
+            try:
+                pairs_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        device = config.training.device[0]
+        x_train, y_train = x_train.to(device), y_train.to(device)
+        if projection is not None:
+            projection.mean = projection.mean.to(device)
+            projection.components = projection.components.to(device)
+        hyper_bank = build_hyper_bank(config)
+        x_base = x_train[:num_samples] if projection is None else projection.project(x_train[:num_samples])
+        base_GP_Model = build_base_GP(config, x_base, y_train[:num_samples],
+                                      num_test=x_train.shape[0] - num_samples - 1, hyper_bank=hyper_bank)
+        for epoch in epochs:
+            if stop.is_set():
+                return
+            pairs = generate_GP_pairs(config, x_train, y_train, num_samples, base_GP_Model, epoch,
+                                      hyper_bank=hyper_bank, projection=projection)
+            if not put(('pairs', epoch, pairs.to('cpu'))):
+                return
+    except BaseException:
+        put(('error', None, traceback.format_exc()))
+
+class PairProducer:
+    def __init__(self, depth, config, x_train, y_train, num_samples, epochs, projection=None):
+        self.closed = False
+        self.epochs = list(epochs)
+        self.device = config.training.device[0]
+        # spawn, not fork: the parent may already hold a CUDA context
+        ctx = mp.get_context('spawn')
+        self.queue = ctx.Queue(maxsize=depth)
+        self.stop = ctx.Event()
+        self.worker = ctx.Process(target=produce_pairs,
+                                  args=(self.queue, self.stop, config, x_train.cpu(), y_train.cpu(), num_samples,
+                                        self.epochs, projection),
+                                  daemon=True)
+        self.worker.start()
+
+    def get(self, epoch):
+        while True:
+            try:
+                kind, produced_epoch, payload = self.queue.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    self.close()
+                    raise RuntimeError(f'pair producer exited before epoch {epoch}')
+        if kind == 'error':
+            self.close()
+            raise RuntimeError(f'pair producer failed:\n{payload}')
+        if produced_epoch != epoch:
+            self.close()
+            raise RuntimeError(f'pair producer is at epoch {produced_epoch}, expected {epoch}')
+        return payload.to(self.device)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop.set()
+        # drain so a worker blocked on a full queue sees the stop event
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.worker.join(timeout=10)
+        if self.worker.is_alive():
+            self.worker.terminate()
+            self.worker.join()
+        self.queue.close()
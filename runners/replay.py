@@ -0,0 +1,95 @@
+import torch
+from runners.utils import PairBank
+
+class ReplayBuffer:
+    # fixed-capacity buffer of GP pairs that the epochs between GP calls train from.
+    #   reservoir - keeps a uniform sample of every pair ever added and draws uniformly
+    #   age       - overwrites the oldest slots ring-style and draws with weight age_decay**age,
+    #               age counted in epochs since the pair was generated
+    # New pairs are generated every `interval` epochs, or earlier once the share of the buffer
+    # that has never been trained on drops below min_freshness.
+    def __init__(self, capacity, interval=1, sampling='reservoir', age_decay=0.9, min_freshness=0.0,
+                 epoch_size=None, start_epoch=0, seed=0):
+        if sampling not in ('reservoir', 'age'):
+            raise NotImplementedError(f'Replay sampling {sampling} not understood.')
+        self.capacity = capacity
+        self.interval = interval
+        self.sampling = sampling
+        self.age_decay = age_decay
+        self.min_freshness = min_freshness
+        self.epoch_size = epoch_size
+        self.start_epoch = start_epoch
+        self.generator = torch.Generator().manual_seed(seed)
+        self.fields = None
+        self.born = None
+        self.uses = None
+        self.size = 0
+        self.seen = 0
+        self.head = 0
+        self.last_added = 0
+        # set when the labelled data changes, so the next epoch regenerates
+        self.stale = False
+
+    def __len__(self):
+        return self.size
+
+    def scheduled(self, epoch):
+        return (epoch - self.start_epoch) % self.interval == 0
+
+    def freshness(self):
+        if self.size == 0:
+            return 0.0
+        return float((self.uses[:self.size] == 0).double().mean())
+
+    def due(self, epoch):
+        return self.size == 0 or self.stale or self.scheduled(epoch) or self.freshness() < self.min_freshness
+
+    def slots(self, m):
+        # destination slot of each of m incoming pairs, -1 where the pair is not kept
+        index = torch.arange(m)
+        if self.sampling == 'age':
+            return (self.head + index) % self.capacity
+        index = self.seen + index
+        replace = torch.floor(torch.rand(m, generator=self.generator, dtype=torch.float64)*(index + 1)).long()
+        slots = torch.where(index < self.capacity, index, replace)
+        return torch.where(slots < self.capacity, slots, torch.full_like(slots, -1))
+
+    def add(self, bank, epoch):
+        self.stale = False
+        if len(bank) == 0:
+            return
+        self.last_added = len(bank)
+        fields = bank.consolidate()
+        if self.fields is None:
+            self.fields = [field.new_empty((self.capacity,) + field.shape[1:]) for field in fields]
+            self.born = torch.zeros(self.capacity, dtype=torch.long, device=fields[0].device)
+            self.uses = torch.zeros(self.capacity, dtype=torch.long, device=fields[0].device)
+        m = len(bank)
+        slots = self.slots(m)
+        # when several incoming pairs land on one slot the latest one wins, as if added one by one
+        keep = slots >= 0
+        last = torch.full((self.capacity,), -1, dtype=torch.long)
+        last.scatter_reduce_(0, slots[keep], torch.arange(m)[keep], reduce='amax')
+        target = torch.nonzero(last >= 0).squeeze(-1)
+        source = last[target].to(fields[0].device)
+        target = target.to(fields[0].device)
+        for buffer, field in zip(self.fields, fields):
+            buffer[target] = field[source]
+        self.born[target] = epoch
+        self.uses[target] = 0
+        self.seen += m
+        self.head = (self.head + m) % self.capacity
+        self.size = min(self.capacity, self.size + m)
+
+    def sample(self, epoch):
+        # the epoch's training pairs, drawn without replacement
+        num = min(self.epoch_size if self.epoch_size is not None else self.last_added, self.size)
+        if num == 0:
+            return PairBank()
+        if self.sampling == 'age':
+            weights = self.age_decay**(epoch - self.born[:self.size]).double().cpu()
+        else:
+            weights = torch.ones(self.size, dtype=torch.float64)
+        index = torch.multinomial(weights, num, replacement=False, generator=self.generator).to(self.born.device)
+        self.uses[index] += 1
+        return PairBank(*[field[index] for field in self.fields])
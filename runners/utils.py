@@ -10,6 +10,17 @@ import design_bench
 # from design_bench.datasets.discrete.tf_bind_10_dataset import TFBind10Dataset
 # from design_bench.datasets.discrete.tf_bind_8_dataset import TFBind8Dataset
 from gaussian_process.GP import GP 
+from gaussian_process.sparse import SparseGP
+from gaussian_process.pathwise import PathwiseSampler
+from gaussian_process.batch import BatchGP
+from gaussian_process.cache import quantize, FactorBank
+from gaussian_process.service import GPClient
+from gaussian_process.fitting import fit_hyperparameters
+from gaussian_process.planner import plan_backend, format_plan
+from gaussian_process.coreset import coreset_selector
+from gaussian_process.pseudo_label import build_pseudo_labeller
+from gaussian_process.ascent import DesignAscent
+from gaussian_process.acceptance import AcceptanceTracker, GapPruner
 
 # NAME_TO_ORACLE_DATASET = {
 #     'AntMorphology-Exact-v0': AntMorphologyDataset,
@@ -67,6 +78,234 @@ def get_optimizer(optim_config, parameters):
     else:
         return NotImplementedError('Optimizer {} not understood.'.format(optim_config.optimizer))
 
+### Optional GP settings from the config's GP block
+GP_OPTION_KEYS = ('kernel', 'kernel_impl', 'cache_sq_dist', 'solver', 'cg_tol', 'cg_max_iter', 'cg_tile_size', 'precond_rank',
+                  'tile_size', 'tile_memory_mb', 'num_workers', 'block_size')
+
+def GP_options(config, plan=None):
+    options = {}
+    for key in GP_OPTION_KEYS:
+        if config.GP.__contains__(key):
+            options[key] = getattr(config.GP, key)
+    if plan is not None:
+        if plan['backend'] != 'sparse':
+            options['solver'] = plan['backend']
+        if plan['tile_memory_mb'] is not None and 'tile_size' not in options:
+            options.setdefault('tile_memory_mb', plan['tile_memory_mb'])
+    return options
+
+PLANNER_OPTION_KEYS = ('cache_sq_dist', 'cg_tile_size', 'precond_rank', 'num_inducing', 'num_workers', 'block_size')
+GP_plans = {}
+
+def plan_GP(config, num_train, dim, num_rhs=1, num_test=0, allow_approx=False, cache_sq_dist=None):
+    # backend chosen under GP.memory_budget_mb; a hand-set GP.solver or GP.approx always wins
+    if not config.GP.__contains__('memory_budget_mb') or config.GP.__contains__('solver') or config.GP.__contains__('approx'):
+        return None
+    allow_approx = allow_approx and config.GP.__contains__('planner_allow_approx') and config.GP.planner_allow_approx
+    key = (num_train, dim, num_rhs, num_test, allow_approx, cache_sq_dist)
+    if key not in GP_plans:
+        options = {}
+        for key_name in PLANNER_OPTION_KEYS:
+            if config.GP.__contains__(key_name):
+                options['tile_size' if key_name == 'cg_tile_size' else key_name] = getattr(config.GP, key_name)
+        if config.GP.__contains__('cg_max_iter'):
+            options['cg_iters'] = min(config.GP.cg_max_iter, 100)
+        if cache_sq_dist is not None:
+            options['cache_sq_dist'] = cache_sq_dist
+        GP_plans[key] = plan_backend(num_train, dim, config.GP.memory_budget_mb, num_rhs=num_rhs, num_test=num_test,
+                                     allow_approx=allow_approx, **options)
+        print(format_plan(GP_plans[key]))
+    return GP_plans[key]
+
+FIT_OPTION_KEYS = ('num_restarts', 'num_steps', 'lr', 'optimizer', 'lengthscale_range', 'outputscale_range',
+                   'noise_range', 'learn_noise', 'seed')
+
+def fit_GP_hyperparameters(config, x_train, y_train, mean_prior=0.0):
+    # type-II ML fit of the base GP on the labelled subset, seeded at the config's current values
+    options = {}
+    for key in FIT_OPTION_KEYS:
+        if config.GP.fit_hyper.__contains__(key):
+            options[key] = getattr(config.GP.fit_hyper, key)
+    return fit_hyperparameters(x_train, y_train,
+                               kernel=config.GP.kernel if config.GP.__contains__('kernel') else 'rbf',
+                               mean_prior=mean_prior,
+                               init=(config.GP.initial_lengthscale, config.GP.initial_outputscale, config.GP.noise),
+                               **options)
+
+PSEUDO_LABEL_OPTION_KEYS = ('num_neighbors', 'num_trees', 'leaf_size', 'num_iters', 'prior_weight', 'cache_dir', 'seed')
+
+def pseudo_labeller_options(config):
+    if not config.GP.__contains__('pseudo_labeller'):
+        return 'gp', {}
+    options = {}
+    for key in PSEUDO_LABEL_OPTION_KEYS:
+        if config.GP.pseudo_labeller.__contains__(key):
+            options[key] = getattr(config.GP.pseudo_labeller, key)
+    return config.GP.pseudo_labeller.engine, options
+
+ASCENT_OPTION_KEYS = ('optimizer', 'grad_tol', 'mu_tol', 'betas', 'eps', 'shrink', 'armijo', 'max_backtracks', 'max_growth')
+
+def ascent_engine(config, num_steps, learning_rate):
+    # fixed-step gradient ascent unless GP.ascent picks an optimizer and convergence tolerances
+    options = {}
+    if config.GP.__contains__('ascent'):
+        for key in ASCENT_OPTION_KEYS:
+            if config.GP.ascent.__contains__(key):
+                options[key] = getattr(config.GP.ascent, key)
+        if 'betas' in options:
+            options['betas'] = tuple(options['betas'])
+    return DesignAscent(num_steps=num_steps, learning_rate=learning_rate, **options)
+
+ACCEPTANCE_OPTION_KEYS = ('prior_rate', 'prior_count', 'min_rate', 'max_points', 'max_rounds', 'prune_after')
+
+def acceptance_options(config):
+    options = {}
+    if config.GP.__contains__('acceptance'):
+        for key in ACCEPTANCE_OPTION_KEYS:
+            if config.GP.acceptance.__contains__(key):
+                options[key] = getattr(config.GP.acceptance, key)
+    return options
+
+def ascend_from(objective, ascent, x_train, start_indices, x_full=None, projection=None, prune=None):
+    # descended and ascended copies of the start designs; start_indices is (n,), or (F, n) for a batch
+    n = start_indices.shape[-1]
+    direction = torch.cat((-torch.ones(n, device=x_train.device), torch.ones(n, device=x_train.device)))
+    start_x = x_train[start_indices]
+    joint_x = torch.cat((start_x, start_x), dim=-2)
+    joint_x = ascent.run(objective, joint_x, direction, prune=prune)
+    with torch.no_grad():
+        joint_y = objective.mean_posterior(joint_x)
+    if projection is not None:
+        joint_x = projection.lift(joint_x, x_full[torch.cat((start_indices, start_indices), dim=-1)])
+    return joint_x, joint_y
+
+def accepted_pairs(ascend, orders, function_ids, targets, tracker, threshold_diff, max_points, max_rounds=4):
+    # rounds of ascent from the next-best unused start points of every function until each has
+    # targets[f] accepted pairs; a round starts from as many points as the tracked acceptance
+    # rates say the neediest function still requires. orders is (F, pool), ascending in y.
+    F, pool = orders.shape
+    banks = [[] for _ in range(F)]
+    accepted = [0]*F
+    used = 0
+    for _ in range(max_rounds):
+        short = [f for f in range(F) if accepted[f] < targets[f]]
+        if not short or used >= pool:
+            break
+        n = max(tracker.points_needed(function_ids[f], targets[f] - accepted[f]) for f in short)
+        n = min(n, max_points, pool - used)
+        joint_x, joint_y = ascend(orders[:, pool-used-n:pool-used])
+        for f in range(F):
+            bank = PairBank()
+            bank.append(joint_x[f], joint_y[f], n, threshold_diff, function_id=function_ids[f])
+            tracker.update(function_ids[f], len(bank), n)
+            banks[f].append(bank)
+            accepted[f] += len(bank)
+        used += n
+    # surplus pairs from the last round are dropped, later (worse) start points first
+    kept = []
+    for f in range(F):
+        bank = PairBank.cat(banks[f])
+        if len(bank) > targets[f]:
+            bank = bank.select(slice(0, targets[f]))
+        kept.append(bank)
+    return PairBank.cat(kept)
+
+def hyper_groups(lengthscales, variances):
+    # indices of the functions sharing each distinct (lengthscale, variance), in order of appearance
+    groups = {}
+    for iter, (lengthscale, variance) in enumerate(zip(lengthscales, variances)):
+        key = (tuple(torch.as_tensor(lengthscale).detach().reshape(-1).tolist()),
+               tuple(torch.as_tensor(variance).detach().reshape(-1).tolist()))
+        groups.setdefault(key, []).append(iter)
+    return list(groups.values())
+
+def service_options(config):
+    service = config.GP.service
+    return {'address': service.address,
+            'autostart': service.autostart if service.__contains__('autostart') else False,
+            'max_memory_mb': service.max_memory_mb if service.__contains__('max_memory_mb') else 4096,
+            'service_device': service.device if service.__contains__('device') else 'cpu'}
+
+def build_refit_GP(config, shared=False, **kwargs):
+    # GP fitted on the pseudo-labelled offline data: exact by default, SGPR with GP.approx: sparse,
+    # or whatever the planner picks under GP.memory_budget_mb. The shared refit on the full offline
+    # data is the same for every job, so under GP.service its factor and solves live in the service.
+    x_train = kwargs['x_train']
+    if shared and config.GP.__contains__('service') and not (config.GP.__contains__('approx') and config.GP.approx == 'sparse'):
+        kwargs.pop('bank', None)
+        kwargs.pop('cache_key', None)
+        kwargs['y_train'] = None
+        return GPClient(**kwargs, **service_options(config), **GP_options(config))
+    # the refit is rebuilt every epoch and factorized once, so its distance cache only pays off
+    # when a bank carries it over to the next epoch
+    cache_sq_dist = kwargs.get('bank') is not None
+    plan = plan_GP(config, x_train.shape[0], x_train.shape[1], num_rhs=config.GP.num_functions,
+                   num_test=2*config.GP.num_points, allow_approx=True, cache_sq_dist=cache_sq_dist)
+    if (config.GP.__contains__('approx') and config.GP.approx == 'sparse') or (plan is not None and plan['backend'] == 'sparse'):
+        sparse_options = {}
+        for key in ('num_inducing', 'inducing_method', 'inducing_jitter'):
+            if config.GP.__contains__(key):
+                sparse_options[key] = getattr(config.GP, key)
+        kwargs.pop('bank', None)
+        kwargs.pop('cache_key', None)
+        return SparseGP(**kwargs, **sparse_options, **GP_options(config, plan))
+    options = GP_options(config, plan)
+    options['cache_sq_dist'] = cache_sq_dist
+    return GP(**kwargs, **options)
+
+def build_hyper_bank(config):
+    # optional bank of kernel factorizations reused across epochs
+    if config.GP.__contains__('bank'):
+        return FactorBank(max_bytes=int(config.GP.bank.max_memory_mb*1024**2))
+    return None
+
+def build_base_GP(config, x_train, y_train, num_test=0, hyper_bank=None):
+    # base GP on the labelled prefix, or a client of the shared GP service under GP.service
+    device = config.training.device[0]
+    lengthscale = torch.tensor(config.GP.initial_lengthscale, device=device)
+    variance = torch.tensor(config.GP.initial_outputscale, device=device)
+    noise = torch.tensor(config.GP.noise, device=device)
+    mean_prior = torch.tensor(0.0, device=device)
+    if config.GP.__contains__('service'):
+        return GPClient(device=device,
+                        x_train=x_train,
+                        y_train=y_train,
+                        lengthscale=lengthscale,
+                        variance=variance,
+                        noise=noise,
+                        mean_prior=mean_prior,
+                        **service_options(config),
+                        **GP_options(config))
+    return GP(device=device,
+              x_train=x_train,
+              y_train=y_train,
+              lengthscale=lengthscale,
+              variance=variance,
+              noise=noise,
+              mean_prior=mean_prior,
+              bank=hyper_bank,
+              cache_key=('base', x_train.shape[0]),
+              **GP_options(config, plan_GP(config, num_train=x_train.shape[0], dim=x_train.shape[1], num_test=num_test)))
+
+def generate_GP_pairs(config, x_train, y_train, num_samples, base_GP_Model, epoch, hyper_bank=None, projection=None):
+    # one epoch of GP training pairs, seeded by the epoch
+    return sampling_data_from_GP(config=config,
+                                 x_train=x_train,
+                                 y_train=y_train,
+                                 num_samples=num_samples,
+                                 device=config.training.device[0],
+                                 base_GP_Model=base_GP_Model,
+                                 num_functions=config.GP.num_functions,
+                                 num_gradient_steps=config.GP.num_gradient_steps,
+                                 num_points=config.GP.num_points,
+                                 learning_rate=config.GP.sampling_from_GP_lr,
+                                 delta_lengthscale=config.GP.delta_lengthscale,
+                                 delta_variance=config.GP.delta_variance,
+                                 seed=epoch,
+                                 threshold_diff=config.GP.threshold_diff,
+                                 hyper_bank=hyper_bank,
+                                 projection=projection)
+
 ### Sampling pretrain data from offline data 
 
 
@@ -150,87 +389,277 @@ def sampling_data_from_trajectories(x_train, y_train, num_points = 1024, thresho
     return datasets 
 
 ### Sampling data from GP model
-def sampling_data_from_GP(config,x_train, y_train, num_samples, device, base_GP_Model, num_gradient_steps = 50, num_functions = 5, num_points = 10, learning_rate = 0.001, delta_lengthscale = 0.1, delta_variance = 0.1, seed = 0, threshold_diff = 0.1):
+class PairBank:
+    # struct-of-arrays store of (high, low) training pairs: four contiguous tensors plus the id of
+    # the GP function that produced each pair. Chunks are appended with one vectorized mask and
+    # concatenated lazily.
+    def __init__(self, x_high=None, y_high=None, x_low=None, y_low=None, function_id=None):
+        self.chunks = []
+        self.fields = None
+        if x_high is not None:
+            self.fields = [x_high, y_high, x_low, y_low, function_id]
+
+    def append(self, joint_x, joint_y, num_points, threshold_diff, function_id):
+        # joint_x holds the descended (low) designs first and the ascended (high) designs second
+        low_x, high_x = joint_x[:num_points].detach(), joint_x[num_points:].detach()
+        low_y, high_y = joint_y[:num_points].detach(), joint_y[num_points:].detach()
+        keep = high_y - low_y > threshold_diff
+        ids = torch.full((int(keep.sum()),), function_id, dtype=torch.long, device=joint_x.device)
+        self.chunks.append([high_x[keep], high_y[keep], low_x[keep], low_y[keep], ids])
+
+    def consolidate(self):
+        if self.chunks:
+            parts = ([self.fields] if self.fields is not None else []) + self.chunks
+            self.fields = [torch.cat(field) for field in zip(*parts)]
+            self.chunks = []
+        return self.fields
+
+    @classmethod
+    def cat(cls, banks):
+        banks = [bank for bank in banks if bank is not None and len(bank) > 0]
+        if not banks:
+            return cls()
+        return cls(*[torch.cat(field) for field in zip(*[bank.consolidate() for bank in banks])])
+
+    def __add__(self, other):
+        return PairBank.cat([self, other])
+
+    def __len__(self):
+        return sum(chunk[0].shape[0] for chunk in self.chunks) + (0 if self.fields is None else self.fields[0].shape[0])
+
+    def select(self, index):
+        return PairBank(*[field[index] for field in self.consolidate()])
+
+    def to(self, device):
+        if len(self) == 0:
+            return PairBank()
+        return PairBank(*[field.to(device) for field in self.consolidate()])
+
+    def split(self, val_frac):
+        # the first val_frac of every function's pairs go to validation, as with the old per-function lists
+        if len(self) == 0:
+            return PairBank(), PairBank()
+        function_id = self.consolidate()[4]
+        counts = torch.bincount(function_id)
+        starts = torch.cumsum(counts, 0) - counts
+        # pairs of one function are contiguous, so the position inside the function is an offset
+        position = torch.arange(function_id.shape[0], device=function_id.device) - starts[function_id]
+        is_val = position < (counts[function_id].double()*val_frac).long()
+        return self.select(~is_val), self.select(is_val)
+
+    def batches(self, batch_size=32, shuffle=True):
+        return PairBatches(self, batch_size=batch_size, shuffle=shuffle)
+
+class PairBatches:
+    # DataLoader replacement over a PairBank: every pass permutes the four arrays once and yields
+    # contiguous slices of them as views, so batches need no collation
+    def __init__(self, bank, batch_size=32, shuffle=True):
+        self.bank = bank
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.bank) + self.batch_size - 1)//self.batch_size
+
+    def __iter__(self):
+        if len(self.bank) == 0:
+            return
+        fields = self.bank.consolidate()
+        if self.shuffle:
+            perm = torch.randperm(fields[0].shape[0]).to(fields[0].device)
+            fields = [field[perm] for field in fields]
+        x_high, y_high, x_low, y_low = fields[:4]
+        for start in range(0, x_high.shape[0], self.batch_size):
+            end = start + self.batch_size
+            yield (x_high[start:end], y_high[start:end]), (x_low[start:end], y_low[start:end])
+
+def sampling_data_from_GP(config,x_train, y_train, num_samples, device, base_GP_Model, num_gradient_steps = 50, num_functions = 5, num_points = 10, learning_rate = 0.001, delta_lengthscale = 0.1, delta_variance = 0.1, seed = 0, threshold_diff = 0.1, hyper_bank = None, projection = None):
+    # with a projection the GPs and the ascent live in its k-dim space and designs are lifted
+    # back to the full space, relative to their starting designs, before they become pairs
+    x_full = x_train
+    if projection is not None:
+        x_train = projection.project(x_train)
     lengthscale = base_GP_Model.kernel.lengthscale
     variance = base_GP_Model.variance 
     torch.manual_seed(seed=seed)
-    datasets={}
-    learning_rate_vec = torch.cat((-learning_rate*torch.ones(num_points, x_train.shape[1], device=device), learning_rate*torch.ones(num_points, x_train.shape[1], device = device)))
-
-
+    pairs = PairBank()
+    ascent = ascent_engine(config, num_gradient_steps, learning_rate)
+    # under GP.ascent every run reports its active rows; GP.ascent.verbose adds the per-step counts
+    report_ascent = config.GP.__contains__('ascent')
+    verbose_ascent = report_ascent and config.GP.ascent.__contains__('verbose') and config.GP.ascent.verbose
+    # with GP.target_pairs every epoch yields that many accepted pairs: start points are
+    # oversampled by the acceptance rate measured so far this epoch, in rounds, and pairs whose
+    # gap cannot reach threshold_diff are pruned mid-ascent (GP.acceptance holds the options)
+    target_pairs = config.GP.target_pairs if config.GP.__contains__('target_pairs') else None
+    acceptance = acceptance_options(config)
+    prune_after = acceptance.get('prune_after', 10 if target_pairs is not None or acceptance else None)
+    tracker = AcceptanceTracker(prior_rate=acceptance.get('prior_rate', 0.5),
+                                prior_count=acceptance.get('prior_count', 8),
+                                min_rate=acceptance.get('min_rate', 0.05))
+    if target_pairs is not None:
+        targets = [target_pairs//num_functions + (iter < target_pairs % num_functions) for iter in range(num_functions)]
+    max_points = acceptance.get('max_points', 8*num_points)
+    pruners = []
+
+    def ascend(objective, start_indices, prefix=''):
+        prune = GapPruner(threshold_diff, num_gradient_steps, prune_after) if prune_after is not None else None
+        joint_x, joint_y = ascend_from(objective, ascent, x_train, start_indices, x_full, projection, prune)
+        if prune is not None:
+            pruners.append(prune)
+        if report_ascent:
+            print(prefix + ascent.summary(), ascent.active_history if verbose_ascent else '')
+        return joint_x, joint_y
+    # refit on num_fit_samples points per function: a uniform random subset for TFBind8 as before,
+    # or a GP.fit_subset coreset (kcenter, leverage, variance) for any task
+    fit_subset = config.GP.fit_subset if config.GP.__contains__('fit_subset') else 'random'
+    subset_fit = config.task.name == 'TFBind8-Exact-v0' or fit_subset != 'random'
+    # with GP.batched all functions are factorized and ascended together as one batch
+    batched = config.GP.__contains__('batched') and config.GP.batched
+    # with GP.function_type: pathwise each function is a posterior sample of its refit GP
+    # instead of the posterior mean
+    pathwise = config.GP.__contains__('function_type') and config.GP.function_type == 'pathwise'
+    num_rff_features = config.GP.num_rff_features if config.GP.__contains__('num_rff_features') else 1024
+    engine, pseudo_label_options = pseudo_labeller_options(config)
+
+    # draw every function's perturbed hyperparameters (and fit subset) in the original RNG order
+    new_lengthscales = []
+    new_variances = []
+    selected_fit_samples = []
     for iter in range(num_functions):
-        datasets[f'f{iter}']=[]
         # add noise to lengthscale and variance
         # new_lengthscale = lengthscale*(1 + delta_lengthscale*(torch.rand(1, device=device)*2 -1))
         # new_variance = variance*(1 + delta_variance*(torch.rand(1, device=device)*2 -1))
         
-        new_lengthscale = lengthscale + delta_lengthscale*(torch.rand(1, device=device)*2 -1)
-        new_variance = variance + delta_variance*(torch.rand(1, device=device)*2 -1)
-        # import pdb ; pdb.set_trace()
-        # change lengthscale and variance of GP
-        base_GP_Model.set_hyper(lengthscale=new_lengthscale,variance = new_variance)
+        u_lengthscale = torch.rand(1, device=device)*2 -1
+        u_variance = torch.rand(1, device=device)*2 -1
+        if hyper_bank is not None:
+            # snap perturbations onto the bank grid so factorizations recur across epochs
+            u_lengthscale = quantize(u_lengthscale, config.GP.bank.grid_size)
+            u_variance = quantize(u_variance, config.GP.bank.grid_size)
+        new_lengthscales.append(lengthscale + delta_lengthscale*u_lengthscale)
+        new_variances.append(variance + delta_variance*u_variance)
         
-        # select random num_points points from offline data
-        y_pred = base_GP_Model.mean_posterior(x_train[num_samples+1:])
-        y_train[num_samples+1:] = y_pred 
+        if subset_fit and fit_subset == 'random': 
+            selected_fit_samples.append(torch.randperm(x_train.shape[0])[:config.GP.num_fit_samples])
+
+    if subset_fit and fit_subset != 'random':
+        # the selector is cached per dataset and base kernel, so later epochs reuse (and only
+        # extend) the same greedy order; leverage sampling draws a fresh subset per function
+        kernel_GP = GP(device, x_train, None, lengthscale, variance, base_GP_Model.noise, base_GP_Model.mean_prior,
+                       kernel=base_GP_Model.kernel_name)
+        selector = coreset_selector(x_train, fit_subset, kernel_rows=kernel_GP.kernel_rows, lengthscale=lengthscale,
+                                    variance=variance, noise=base_GP_Model.noise)
+        generator = torch.Generator().manual_seed(seed)
+        selected_fit_samples = [selector.select(config.GP.num_fit_samples, generator=generator) for _ in range(num_functions)]
+
+    # pseudo-label the unlabeled pool under each function's perturbed hyperparameters, with the
+    # base GP or, under GP.pseudo_labeller, label propagation over a cached kNN graph
+    pseudo_labeller = build_pseudo_labeller(engine, base_GP_Model, batched=batched, **pseudo_label_options)
+    pseudo_labels = []
+    for y_pred in pseudo_labeller(x_train, y_train, num_samples, new_lengthscales, new_variances):
+        y_train[num_samples+1:] = y_pred
+        pseudo_labels.append(y_train.clone())
+    
+    if not subset_fit:
+        # every function refits on the same inputs under its own perturbed hyperparameters; functions
+        # whose (lengthscale, variance) coincide, as on the GP.bank grid, share one factorization and
+        # their label vectors are solved in one call
+        labels = torch.stack(pseudo_labels, dim=1)
+        GP_Model = build_refit_GP(config,
+                    shared=True,
+                    device=device,
+                    x_train=x_train,
+                    y_train=y_train,
+                    lengthscale=new_lengthscales[0], 
+                    variance=new_variances[0], 
+                    noise=base_GP_Model.noise, 
+                    mean_prior=base_GP_Model.mean_prior,
+                    bank=hyper_bank,
+                    cache_key=('full', x_train.shape[0], num_samples))
+        coefs = torch.empty_like(labels)
+        functions = [None]*num_functions
+        for group in hyper_groups(new_lengthscales, new_variances):
+            GP_Model.kernel.lengthscale = new_lengthscales[group[0]]
+            GP_Model.variance = new_variances[group[0]]
+            coefs[:, group] = GP_Model.solve(labels[:, group])
+            if pathwise:
+                sampler = PathwiseSampler(GP_Model, y=labels[:, group], num_features=num_rff_features)
+                for index, iter in enumerate(group):
+                    functions[iter] = sampler.function(index)
+
+    if batched and not pathwise:
+        if subset_fit:
+            objective = BatchGP(device=device,
+                                x_train=torch.stack([x_train[idx] for idx in selected_fit_samples]),
+                                y_train=torch.stack([pseudo_labels[iter][idx] for iter, idx in enumerate(selected_fit_samples)]),
+                                lengthscale=torch.cat([torch.as_tensor(l).detach().reshape(-1) for l in new_lengthscales]),
+                                variance=torch.cat([torch.as_tensor(v).detach().reshape(-1) for v in new_variances]),
+                                noise=base_GP_Model.noise,
+                                mean_prior=base_GP_Model.mean_prior,
+                                kernel=base_GP_Model.kernel_name)
+            objective.set_hyper(lengthscale=objective.lengthscale, variance=objective.variance)
+        else:
+            objective = BatchGP.from_refit(GP_Model, coefs, lengthscale=new_lengthscales, variance=new_variances)
         
-        if config.task.name == 'TFBind8-Exact-v0': 
-            selected_fit_samples = torch.randperm(x_train.shape[0])[:config.GP.num_fit_samples]
-            GP_Model = GP(device=device,
-                x_train=x_train[selected_fit_samples],
-                y_train=y_train[selected_fit_samples],
-                lengthscale=base_GP_Model.kernel.lengthscale, 
-                variance=base_GP_Model.variance, 
-                noise=base_GP_Model.noise, 
-                mean_prior=base_GP_Model.mean_prior)
+        # all functions' designs advance together: joint_x is (num_functions, 2*num_points, D)
+        orders = torch.stack([torch.argsort(y_train_iter) for y_train_iter in pseudo_labels])
+        if target_pairs is None:
+            joint_x, joint_y = ascend(objective, orders[:, -num_points:])
+            for iter in range(num_functions):
+                pairs.append(joint_x[iter], joint_y[iter], num_points, threshold_diff, function_id=iter)
+        else:
+            pairs = accepted_pairs(lambda start_indices: ascend(objective, start_indices),
+                                   orders, list(range(num_functions)), targets, tracker, threshold_diff,
+                                   max_points, acceptance.get('max_rounds', 4))
+    else:
+        for iter in range(num_functions):
+            y_train_iter = pseudo_labels[iter]
             
-        else: 
-            GP_Model = GP(device=device,
-                        x_train=x_train,
-                        y_train=y_train,
-                        lengthscale=base_GP_Model.kernel.lengthscale, 
-                        variance=base_GP_Model.variance, 
-                        noise=base_GP_Model.noise, 
-                        mean_prior=base_GP_Model.mean_prior)
-        GP_Model.set_hyper(lengthscale=base_GP_Model.kernel.lengthscale, variance=base_GP_Model.variance)
-        
-
-        selected_indices = torch.argsort(y_train)[-num_points:]
-        # low_y = y_pred[selected_indices].clone().detach().requires_grad_(True)
-        low_x = x_train[selected_indices].clone().detach().requires_grad_(True)
-        high_x = x_train[selected_indices].clone().detach().requires_grad_(True)
-        joint_x = torch.cat((low_x, high_x)) 
-        
-        # Using gradient ascent and descent to find high and low designs 
-        for t in range(num_gradient_steps): 
-            mu_star = GP_Model.mean_posterior(joint_x)
-            grad = torch.autograd.grad(mu_star.sum(),joint_x)[0]
-            joint_x += learning_rate_vec*grad 
-            # mu_star = GP_Model.mean_posterior(high_x) 
-            # grad = torch.autograd.grad(mu_star.sum(),high_x)[0] 
-            # high_x = high_x.add(grad, alpha = learning_rate)
-        
-        # high_y = GP_Model.mean_posterior(high_x)
-        
-        joint_y = GP_Model.mean_posterior(joint_x)
-        
-        low_x = joint_x[:num_points,:]
-        high_x = joint_x[num_points:,:]
-        low_y = joint_y[:num_points]
-        high_y = joint_y[num_points:]
-        
-        
-        for i in range(num_points):
-            if high_y[i] - low_y[i] <= threshold_diff:
-                continue
-            sample = [(high_x[i].detach(),high_y[i].detach()),(low_x[i].detach(),low_y[i].detach())]
-            datasets[f'f{iter}'].append(sample)
+            if subset_fit: 
+                GP_Model = build_refit_GP(config,
+                    device=device,
+                    x_train=x_train[selected_fit_samples[iter]],
+                    y_train=y_train_iter[selected_fit_samples[iter]],
+                    lengthscale=new_lengthscales[iter], 
+                    variance=new_variances[iter], 
+                    noise=base_GP_Model.noise, 
+                    mean_prior=base_GP_Model.mean_prior)
+                GP_Model.set_hyper(lengthscale=new_lengthscales[iter], variance=new_variances[iter])
+                objective = PathwiseSampler(GP_Model, num_features=num_rff_features).function(0) if pathwise else GP_Model
+            else: 
+                # the posterior mean only needs the function's hyperparameters and coefficients
+                GP_Model.kernel.lengthscale = new_lengthscales[iter]
+                GP_Model.variance = new_variances[iter]
+                GP_Model.y_train = y_train_iter
+                GP_Model.coef = coefs[:, iter]
+                objective = functions[iter] if pathwise else GP_Model
+            
+            # Using gradient ascent and descent to find high and low designs; the posterior mean
+            # gradient is evaluated in closed form, so no autograd graph is built
+            order = torch.argsort(y_train_iter)
+            if target_pairs is None:
+                joint_x, joint_y = ascend(objective, order[-num_points:], prefix=f'function {iter}: ')
+                pairs.append(joint_x, joint_y, num_points, threshold_diff, function_id=iter)
+            else:
+                ascend_one = lambda start_indices: [t.unsqueeze(0) for t in ascend(objective, start_indices[0], prefix=f'function {iter}: ')]
+                pairs = pairs + accepted_pairs(ascend_one, order.unsqueeze(0), [iter], [targets[iter]], tracker,
+                                               threshold_diff, max_points, acceptance.get('max_rounds', 4))
+
+    if target_pairs is not None:
+        tried = sum(tracker.tried.values())
+        print(f'target pairs {target_pairs}: accepted {len(pairs)} from {tried} start points '
+              f'({sum(tracker.accepted.values())/max(tried, 1):.1%} acceptance), '
+              f'{sum(prune.num_pruned() for prune in pruners)} pairs pruned mid-ascent')
+
+    if not subset_fit and isinstance(GP_Model, GPClient):
+        # the service keeps the factor; only this epoch's connection goes
+        GP_Model.close()
 
     # restore lengthscale and variance of GP
     base_GP_Model.kernel.lengthscale = lengthscale
     base_GP_Model.variance = variance
     
-    return datasets
+    return pairs
 
 class CustomDataset(Dataset):
     def __init__(self, data):
@@ -245,6 +674,9 @@ class CustomDataset(Dataset):
 
 # Create a DataLoader for each epoch
 def create_train_dataloader(data_from_GP, val_frac=0.2, batch_size=32, shuffle=True):
+    if isinstance(data_from_GP, PairBank):
+        train_bank, val_bank = data_from_GP.split(val_frac)
+        return train_bank.batches(batch_size=batch_size, shuffle=shuffle), val_bank
     train_data = []
     val_data = []
     for function, function_samples in data_from_GP.items():
@@ -260,7 +692,8 @@ def create_train_dataloader(data_from_GP, val_frac=0.2, batch_size=32, shuffle=T
     return train_dataloader, val_data
 
 def create_val_dataloader(val_dataset, batch_size=32, shuffle=False):
-    
+    if isinstance(val_dataset, PairBank):
+        return val_dataset.batches(batch_size=batch_size, shuffle=shuffle)
     valid_dataset = CustomDataset(val_dataset)
     valid_dataloader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=shuffle)
 